@@ -0,0 +1,257 @@
+"""AsyncUnionFind.py
+asyncio implementation of disjoint sets data structures, for python 3.
+
+Backends mirror the ones in UnionFind.py: every operation is a coroutine,
+so that database round trips do not block the event loop, and independent
+finds can be awaited concurrently.
+
+"""
+import abc
+import asyncio
+
+
+class AsyncParents(abc.ABC):
+    """
+    Abstract class to define the interface of asynchronous disjoint sets objects
+    """
+    @abc.abstractmethod
+    async def get(self, obj):
+        """ Return the element `{'parent': ..., 'weight': ...}` of the object `obj`, or None if it is not present. """
+        return
+
+    @abc.abstractmethod
+    async def add(self, obj):
+        """ Add the object `obj` as a singleton with weight 1, unless it is present. Return True if it was added. """
+        return
+
+    @abc.abstractmethod
+    async def set_parents(self, mapping):
+        """ Update the parent of each object in the dict `mapping` to the value it maps to. """
+        return
+
+    @abc.abstractmethod
+    async def inc_weight(self, obj, weight):
+        """ Increment the weight of the object `obj` by the value of the argument `weight`. """
+        return
+
+    @abc.abstractmethod
+    def items(self):
+        """ Asynchronously iterate over the 2-tuples `(object, element)` """
+        return
+
+
+class AsyncDictParents(AsyncParents):
+    """
+    Handle disjoint sets in memory, as a stand-in for the database backends.
+
+    Each call counts as a round trip and optionally waits `latency` seconds,
+    to simulate a database server.
+    """
+    def __init__(self, latency=0):
+        self._parents = {}
+        self.latency = latency
+        self.round_trips = 0
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get(self, obj):
+        await self._round_trip()
+        el = self._parents.get(obj)
+        return None if el is None else dict(el)
+
+    async def add(self, obj):
+        await self._round_trip()
+        if obj in self._parents:
+            return False
+        self._parents[obj] = {'parent': obj, 'weight': 1}
+        return True
+
+    async def set_parents(self, mapping):
+        await self._round_trip()
+        for obj, parent in mapping.items():
+            self._parents[obj]['parent'] = parent
+
+    async def inc_weight(self, obj, weight):
+        await self._round_trip()
+        self._parents[obj]['weight'] += weight
+
+    async def items(self):
+        await self._round_trip()
+        for obj, el in list(self._parents.items()):
+            yield obj, dict(el)
+
+
+class AsyncMongoParents(AsyncParents):
+    """
+    Handle disjoint sets, via mongodb and the motor asyncio driver.
+    """
+    def __init__(self, db, collection):
+        """
+        Parameters:
+        -----------
+        :param db: an instance of motor.motor_asyncio.AsyncIOMotorDatabase
+        :param collection: a string representing the collection in the db
+        """
+        self.db = db
+        self.collection = collection
+
+    async def get(self, obj):
+        return await self.db[self.collection].find_one({'_id': obj})
+
+    async def add(self, obj):
+        res = await self.db[self.collection].update_one(
+            {'_id': obj}, {'$setOnInsert': {'parent': obj, 'weight': 1}}, upsert=True)
+        return res.upserted_id is not None
+
+    async def set_parents(self, mapping):
+        import pymongo
+        if mapping:
+            requests = [pymongo.UpdateOne({'_id': obj}, {'$set': {'parent': parent}}) for obj, parent in mapping.items()]
+            await self.db[self.collection].bulk_write(requests, ordered=False)
+
+    async def inc_weight(self, obj, weight):
+        await self.db[self.collection].update_one({'_id': obj}, {'$inc': {'weight': weight}})
+
+    async def items(self):
+        async for el in self.db[self.collection].find():
+            yield el.pop('_id'), el
+
+
+class AsyncMySQLParents(AsyncParents):
+    """
+    Handle disjoint sets, via mysql and a pool of the aiomysql asyncio driver.
+    """
+    def __init__(self, pool, table, **extra_fields):
+        """
+        Parameters:
+        -----------
+        :param pool: an instance of aiomysql.Pool
+        :param table: a string representing the table in the db
+        :param **extra_fields: extra fields that are matched and added to each row
+        """
+        self.pool = pool
+        self.table = table
+        self.extra_fields = extra_fields
+        # queries are built once, extra fields are passed as arguments
+        f_names = tuple(extra_fields.keys())
+        self._extra = tuple(extra_fields[f_name] for f_name in f_names)
+        where = ''.join(' %s = %%s AND ' % f_name for f_name in f_names)
+        columns = ''.join(' %s, ' % f_name for f_name in f_names)
+        values = '%s, ' * len(f_names)
+        self._sql_find_all = ' SELECT * FROM %s WHERE %s TRUE ' % (table, where)
+        self._sql_find_obj = ' SELECT * FROM %s WHERE %s _id = %%s ' % (table, where)
+        self._sql_add_obj = ' INSERT IGNORE INTO %s (%s_id, parent, weight) VALUES (%s%%s, %%s, 1) ' % (
+            table, columns, values)
+        self._sql_set_parents = ' INSERT INTO %s (%s_id, parent, weight) VALUES %%s ' % (table, columns)
+        self._sql_set_parents += ' ON DUPLICATE KEY UPDATE parent = VALUES(parent) '
+        self._sql_set_parents_row = '(%s%%s, %%s, 1)' % values
+        self._sql_inc_weight = ' UPDATE %s SET weight = weight + %%s WHERE %s _id = %%s ' % (table, where)
+
+    async def _execute(self, query, args=(), fetch=None):
+        import aiomysql
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                count = await cur.execute(query, args)
+                res = await cur.fetchall() if fetch else count
+            await conn.commit()
+        return res
+
+    async def get(self, obj):
+        rows = await self._execute(self._sql_find_obj, self._extra + (obj,), fetch=True)
+        return rows[0] if rows else None
+
+    async def add(self, obj):
+        return await self._execute(self._sql_add_obj, self._extra + (obj, obj)) > 0
+
+    async def set_parents(self, mapping):
+        if not mapping:
+            return
+        args = []
+        for obj, parent in mapping.items():
+            args.extend(self._extra + (obj, parent))
+        query = self._sql_set_parents % ', '.join([self._sql_set_parents_row] * len(mapping))
+        await self._execute(query, args)
+
+    async def inc_weight(self, obj, weight):
+        await self._execute(self._sql_inc_weight, (weight,) + self._extra + (obj,))
+
+    async def items(self):
+        for el in await self._execute(self._sql_find_all, self._extra, fetch=True):
+            yield el.pop('_id'), el
+
+
+class AsyncUnionFind:
+    """Union-find data structure for asyncio.
+
+    The asynchronous counterpart of UnionFind.UnionFind:
+
+    - await X.find(item) returns a name for the set containing the given item,
+      adding it as a singleton if it is not yet part of a set in X.
+
+    - await X.union(item1, item2, ...) merges the sets containing each item.
+
+    Finds run concurrently, without locking: path compression only makes an
+    object point to one of its ancestors. Linking roots is serialized by a
+    lock, and roots are checked again under the lock before being linked.
+    """
+    def __init__(self, parents=None):
+        """Create a new empty union-find structure.
+
+        Parameters
+        :param parents: an instance of AsyncParents, by default an in-memory AsyncDictParents
+        """
+        self.parents = parents if parents is not None else AsyncDictParents()
+        self._lock = None  # created on first use, within the running event loop
+
+    async def find(self, obj):
+        """Find and return the name of the set containing the object."""
+        el = await self.parents.get(obj)
+        if el is None and await self.parents.add(obj):
+            return obj
+        if el is None:  # added by another task in the meantime
+            el = await self.parents.get(obj)
+
+        # find path of objects leading to the root
+        path = [obj]
+        root = el['parent']
+        while root != path[-1]:
+            path.append(root)
+            root = (await self.parents.get(root))['parent']
+
+        # compress the path and return. The last two objects are
+        # the root and its child, which already point to the root
+        if len(path) > 2:
+            await self.parents.set_parents(dict.fromkeys(path[:-2], root))
+        return root
+
+    async def find_many(self, objects):
+        """Return the names of the sets containing each object, resolving them concurrently."""
+        return await asyncio.gather(*[self.find(x) for x in objects])
+
+    async def union(self, *objects):
+        """Find the sets containing the objects and merge them all."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        roots = list(set(await self.find_many(objects)))
+        while len(roots) > 1:
+            async with self._lock:
+                els = await asyncio.gather(*[self.parents.get(r) for r in roots])
+                if all(el['parent'] == r for r, el in zip(roots, els)):
+                    heaviest = max([(el['weight'], r) for r, el in zip(roots, els)])[1]
+                    others = [r for r in roots if r != heaviest]
+                    weight = sum(el['weight'] for r, el in zip(roots, els) if r != heaviest)
+                    await asyncio.gather(self.parents.inc_weight(heaviest, weight),
+                                         self.parents.set_parents(dict.fromkeys(others, heaviest)))
+                    return
+            # another task linked one of the roots in the meantime
+            roots = list(set(await self.find_many(roots)))
+
+    async def items(self):
+        """
+        Asynchronously iterate over 2-tuples containing element and root of the set containing it.
+        """
+        async for obj, el in self.parents.items():
+            yield obj, await self.find(obj)
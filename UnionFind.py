@@ -9,16 +9,71 @@ with significant additional changes by D. Eppstein.
 
 """
 import abc
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict, deque
+from itertools import chain, count, groupby, islice
+
 try:
-    import pymongo
-    import MySQLdb
-    from warnings import filterwarnings
-    filterwarnings('ignore', category=MySQLdb.Warning)
-except ImportError:
-    # we can still use union-find with standard python dictionaries
-    pass
+    from itertools import izip
+except ImportError:  # python 3
+    izip = zip
+
+# database drivers are imported on first use, see register_storage(). So are pickle, struct,
+# threading and the other modules that only some features need, to keep `import UnionFind` cheap
+available_storage = []
+
+text_type = type(u'')
+integer_types = (int, type(2 ** 64))  # int and long on python 2
+
+# binary snapshots: header, then parents, weights and the sorted key table
+_SNAPSHOT_MAGIC = b'UFSNAP2\0'
+_SNAPSHOT_HEADER = '<8sc7xqq'  # struct format: magic, kind of keys, number of elements, last journal record
+
+# journal records: length and crc32 of the pickled operation, sequence number, then the operation
+_JOURNAL_HEADER = '<IIq'  # struct format
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def _is_instance(obj, module, name):
+    """ Return True if `obj` is an instance of the class `name` of a driver module,
+    without importing the module: objects of a module that is not imported yet can not exist.
+    """
+    cls = sys.modules.get(module)
+    if cls is None:
+        return False
+    for attr in name.split('.'):
+        cls = getattr(cls, attr)
+    return isinstance(obj, cls)
+
+
+def _is_mongodb(db):
+    return _is_instance(db, 'pymongo', 'database.Database')
+
+
+def _is_mysql(db):
+    return _is_instance(db, 'MySQLdb', 'connections.Connection')
+
 
-available_storage = ['mongodb', 'mysql']
+def _is_sqlite(db):
+    return _is_instance(db, 'sqlite3', 'Connection')
+
+
+_mysql_warnings_ignored = False
+
+
+def _import_mysqldb():
+    """ Import MySQLdb, silencing its warnings once. """
+    global _mysql_warnings_ignored
+    import MySQLdb
+    if not _mysql_warnings_ignored:
+        from warnings import filterwarnings
+        filterwarnings('ignore', category=MySQLdb.Warning)
+        _mysql_warnings_ignored = True
+    return MySQLdb
 
 
 class Parents(object):
@@ -54,123 +109,534 @@ class Parents(object):
         """ Return the objects in the disjoint sets as a list of 2-tuples `(object, parent_object)` """
         return
 
+    def parent_of(self, obj):
+        """ Return the parent of the object `obj`. Engines may override it to avoid building a dict. """
+        return self[obj]['parent']
+
+    def weight_of(self, obj):
+        """ Return the weight of the object `obj`. Engines may override it to avoid building a dict. """
+        return self[obj]['weight']
+
+    # engines that keep a circular list of the members of each set set it to True
+    tracks_members = False
+
+    # engines that can resolve a whole path with a single query set it to True
+    server_side_find = False
+
+    def find_path(self, obj):
+        """ Return the list of the objects from `obj` up to the root of its set, both included. """
+        parent_of = self.parent_of
+        path = [obj]
+        root = parent_of(obj)
+        while root != path[-1]:
+            path.append(root)
+            root = parent_of(root)
+        return path
+
+    def set_parents(self, mapping):
+        """ Update the parent of each object in the dict `mapping` to the value it maps to.
+        Engines may override it to write all the updates at once.
+        """
+        for obj, parent in mapping.items():
+            self[obj] = parent
+
+    def upsert_many(self, mapping):
+        """ Set the parent and the weight of each object in the dict `mapping`, object -> (parent, weight),
+        adding the objects that are not present. Engines may override it to write all of them at once.
+        """
+        present = self.parents_of(mapping)
+        for obj in mapping:
+            if obj not in present:  # add new objects first, so that they can be used as parents below
+                self[obj] = obj
+        for obj, (parent, weight) in mapping.items():
+            delta = weight - (self.weight_of(obj) if obj in present else 1)
+            if delta:
+                self.inc_weight(obj, delta)
+        self.set_parents(dict((obj, parent) for obj, (parent, weight) in mapping.items()))
+
+    def parents_of(self, objects):
+        """ Return a dict mapping each of the `objects` that is present to its parent.
+        Engines may override it to fetch all the parents at once.
+        """
+        parents = {}
+        for obj in objects:
+            try:
+                el = self[obj]
+            except KeyError:
+                el = None
+            if el is not None:
+                parents[obj] = el['parent']
+        return parents
+
+    def children_of(self, objects):
+        """ Return a dict mapping each of the `objects` that has children to the list of its children,
+        leaving out roots, which are their own parents. Engines may override it to fetch them at once.
+        """
+        objects = set(objects)
+        children = {}
+        for obj, el in self.items():
+            if el['parent'] in objects and el['parent'] != obj:
+                children.setdefault(el['parent'], []).append(obj)
+        return children
+
+    def link_members(self, root, other):
+        """ Join the member lists of the sets named by `root` and `other`, if members are tracked. """
+        return
+
+    def unlink_member(self, obj):
+        """ Remove `obj` from the member list of its set, leaving it alone in a list of its own.
+        Return the member that preceded it, if members are tracked: link_members(that member, obj) undoes it.
+        """
+        return
+
+    def iter_members(self, obj):
+        """ Iterate over the objects in the set containing `obj`, if members are tracked. """
+        raise NotImplementedError('members are not tracked by %s' % type(self).__name__)
+
+    def iter_children(self):
+        """ Return the objects grouped by parent, as lists. Paths are expected to be compressed. """
+        children = {}
+        for obj, el in self.items():
+            children.setdefault(el['parent'], []).append(obj)
+        return iter(children.values())
+
+class MySQLPool(object):
+    """
+    A bounded pool of mysql connections, that many MySQLParents, e.g. one per namespace of
+    extra fields, can share. Connections are opened on demand, up to `size`, and callers
+    wait for a free one beyond that.
+
+    Counters: `queries` run, `acquisitions` of a connection, `waits` for a free connection
+    and the total `wait_seconds`.
+    """
+    def __init__(self, connect, size=8, timeout=None, autocommit=True):
+        """
+        Parameters:
+        -----------
+        :param connect: a function returning a new MySQLdb connection, e.g. lambda: MySQLdb.connect(host, user, ...)
+        :param size: the maximum number of open connections
+        :param timeout: seconds to wait for a free connection before raising RuntimeError, None waits forever
+        :param autocommit: if True, connections are opened in autocommit mode, so that reads on one connection
+            see the writes made on the others without a COMMIT round trip. Otherwise writes are committed
+        """
+        import threading
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.autocommit = autocommit
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self.queries = 0
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """ Return a free connection, opening one or waiting for one to be released. """
+        with self._cond:
+            self.acquisitions += 1
+            if not self._idle and self._open >= self.size:
+                self.waits += 1
+                start = timer()
+                while not self._idle and self._open >= self.size:
+                    remaining = None if self.timeout is None else self.timeout - (timer() - start)
+                    if remaining is not None and remaining <= 0:
+                        self.wait_seconds += timer() - start
+                        raise RuntimeError('no free mysql connection after %s seconds' % self.timeout)
+                    self._cond.wait(remaining)
+                self.wait_seconds += timer() - start
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        try:
+            db = self._connect()
+            if self.autocommit:
+                db.autocommit(True)
+            return db
+        except Exception:
+            self._discard()
+            raise
+
+    def release(self, db):
+        """ Give back a connection returned by acquire(). """
+        with self._cond:
+            self._idle.append(db)
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def execute(self, query, args=None, write=False, cursorclass=None):
+        """ Run a query on a free connection, and return the rows it fetched or, if `write`, the number of rows it changed. """
+        db = self.acquire()
+        try:
+            cur = db.cursor(cursorclass) if cursorclass is not None else db.cursor()
+            try:
+                count = cur.execute(query, args)
+                res = count if write else cur.fetchall()
+            finally:
+                cur.close()
+            if write and not self.autocommit:
+                db.commit()
+        except Exception:
+            try:
+                db.rollback()
+            except Exception:  # the connection is broken, another one is opened when needed
+                self._discard()
+                raise
+            self.release(db)
+            raise
+        with self._cond:
+            self.queries += 1
+        self.release(db)
+        return res
+
+    def close(self):
+        """ Close the idle connections. """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for db in idle:
+            db.close()
+
+
+def _mysql_pool(db):
+    """ Return `db` if it is a MySQLPool, otherwise a pool of the single connection `db`, left as it is. """
+    if isinstance(db, MySQLPool):
+        return db
+    if not _is_mysql(db):
+        raise TypeError('db must be a valid instance of MySQLdb.connections.Connection or MySQLPool')
+    return MySQLPool(lambda: db, size=1, autocommit=False)
+
+
 class MySQLParents(Parents):
     """
     Handle disjoint sets, via mysql.
+
+    Queries are built once, with the extra fields passed as arguments, and run on
+    the connections of a MySQLPool.
     """
-    def __init__(self, db, table=None, **extra_fields):
+    def __init__(self, db, table=None, server_side_find=False, **extra_fields):
         """
         Parameters:
         -----------
-        :param db: an instance of MySQLdb.connections.Connection or None
+        :param db: an instance of MySQLdb.connections.Connection, or a MySQLPool shared with other instances
         :param table: a string representing the table in the db or None
+        :param server_side_find: if True, resolve roots with a single recursive query, which requires MySQL 8.0
         """
-        if not isinstance(db, MySQLdb.connections.Connection):
-            raise TypeError('db must be a valid instance of MySQLdb.connections.Connection')
-
+        self.pool = _mysql_pool(db)
         self.db = db
-        self.cur = db.cursor(MySQLdb.cursors.DictCursor)
         self.table = table
+        self.server_side_find = server_side_find
         self.extra_fields = extra_fields
-
-    def _sql_where(self, obj=False):
-        if not self.extra_fields and not obj:
-            return ''  # no conditions can be set
-        query = ' WHERE '
-        extra_fields = []
-        for f_name, f_val in self.extra_fields.iteritems():  # possibly match extra fields
-            extra_fields.append(" %s = '%s' " % (f_name, f_val))
-        query += ' AND '.join(extra_fields)
-        if extra_fields and obj:  # we need one extra AND at the end of extra fields
-            query += ' AND '
-        if obj:
-            query += " _id = %s "  # this time we let mysql replace the %s
-        return query
-
-    @property
-    def _sql_find_all(self):
-        """
-        Selects the items in the database, possibly including extra fields
-        """
-        query = " SELECT * FROM %s " % self.table
-        if not self.extra_fields:  # no need to filter using a where clause
-            return query
-        else:
-            return query + self._sql_where(obj=False)
-
-    @property
-    def _sql_find_obj(self):
-        query = " SELECT * FROM %s " % self.table
-        return query + self._sql_where(obj=True)
-
-    @property
-    def _sql_insert_obj(self):
-        """
-        Adds optional extra_fields and inserts the object into the database
-        """
-        query = " INSERT INTO %s " % self.table
-        query += 'SET '
-        for f_name, f_val in self.extra_fields.iteritems():
-            query += " %s = '%s', " % (f_name, f_val)
-        query += "_id = %s, parent = %s, weight = %s"  # _id, parent and weight
-        query += " ON DUPLICATE KEY UPDATE parent = %s"  # simulate an UPSERT
-        return query
+        self._dict_cursor = _import_mysqldb().cursors.DictCursor
+
+        f_names = tuple(extra_fields.keys())
+        self._extra = tuple(extra_fields[f_name] for f_name in f_names)
+        where = ''.join(' %s = %%s AND ' % f_name for f_name in f_names)  # possibly match extra fields
+        columns = ''.join(' %s, ' % f_name for f_name in f_names)
+        values = '%s, ' * len(f_names)
+        self._sql_find_all = ' SELECT * FROM %s WHERE %s TRUE ' % (table, where)
+        self._sql_find_obj = ' SELECT * FROM %s WHERE %s _id = %%s ' % (table, where)
+        self._sql_upsert_row = '(%s%%s, %%s, %%s)' % values
+        self._sql_upsert = ' INSERT INTO %s (%s_id, parent, weight) VALUES ' % (table, columns)
+        self._sql_on_duplicate = ' ON DUPLICATE KEY UPDATE parent = VALUES(parent) '
+        self._sql_on_duplicate_weight = ' ON DUPLICATE KEY UPDATE parent = VALUES(parent), weight = VALUES(weight) '
+        self._sql_update_parents = ' UPDATE %s SET parent = %%s WHERE %s _id IN ' % (table, where)
+        self._sql_parents_of = ' SELECT _id, parent FROM %s WHERE %s _id IN ' % (table, where)
+        self._sql_children_of = ' SELECT _id, parent FROM %s WHERE %s _id <> parent AND parent IN ' % (table, where)
+        self._sql_inc_weight = ' UPDATE %s SET weight = weight + %%s WHERE %s _id = %%s ' % (table, where)
+        self._sql_children = ' SELECT _id, parent FROM %s WHERE %s TRUE ORDER BY parent ' % (table, where)
+        # walks up the parents of an object on the server, with a recursive common table expression
+        join_extra = ''.join(' AND t.%s = %%s ' % f_name for f_name in f_names)
+        self._sql_find_path = ' WITH RECURSIVE path (_id, parent, depth) AS ( ' \
+                              ' SELECT _id, parent, 0 FROM %s WHERE %s _id = %%s ' \
+                              ' UNION ALL ' \
+                              ' SELECT t._id, t.parent, path.depth + 1 FROM path JOIN %s t ' \
+                              ' ON t._id = path.parent %s WHERE path._id <> path.parent ) ' \
+                              ' SELECT _id FROM path ORDER BY depth ' % (table, where, table, join_extra)
+
+    def _fetch(self, query, args=()):
+        return self.pool.execute(query, args, cursorclass=self._dict_cursor)
+
+    def _write(self, query, args=()):
+        return self.pool.execute(query, args, write=True)
+
+    def _find_obj(self, obj):
+        rows = self._fetch(self._sql_find_obj, self._extra + (obj,))
+        return rows[0] if rows else None
 
     def __contains__(self, obj):
-        query = self._sql_find_obj
-        self.cur.execute(query, (obj,))
-        return self.cur.rowcount > 0
+        return self._find_obj(obj) is not None
 
     def __getitem__(self, obj):
-        query = self._sql_find_obj
-        self.cur.execute(query, (obj,))
-        return self.cur.fetchone()
+        return self._find_obj(obj)
 
     def __setitem__(self, obj, parent):
-        query = self._sql_find_obj
-        self.cur.execute(query, (obj,))
-        obj_el = self.cur.fetchone()
+        obj_el = self._find_obj(obj)
         if obj_el is None:  # there wasn't any row with column _id equal to key in the database!
             # ignore the parent !
             obj_el = {'_id': obj, 'parent': obj, 'weight': 1}
         else:  # there is already an entry with _id equal to they key!
-            self.cur.execute(query, (parent,))
-            parent_el = self.cur.fetchone()
+            parent_el = self._find_obj(parent)
             obj_el['parent'] = parent_el['_id']
-        with self.db:
-            # simulate an UPSERT
-            query = self._sql_insert_obj
-            self.cur.execute(query, (obj_el['_id'], obj_el['parent'], obj_el['weight'], obj_el['parent']))
+        # simulate an UPSERT
+        self._write(self._sql_upsert + self._sql_upsert_row + self._sql_on_duplicate,
+                    self._extra + (obj_el['_id'], obj_el['parent'], obj_el['weight']))
+
+    def find_path(self, obj):
+        if not self.server_side_find:
+            return Parents.find_path(self, obj)
+        path = [el['_id'] for el in self._fetch(self._sql_find_path, self._extra + (obj,) + self._extra)]
+        if not path:
+            raise KeyError(obj)
+        return path
+
+    def set_parents(self, mapping):
+        if not mapping:
+            return
+        parents = set(mapping.values())
+        if len(parents) == 1:
+            # e.g. a compressed path, a single set-based UPDATE
+            query = self._sql_update_parents + '(%s)' % ', '.join(['%s'] * len(mapping))
+            self._write(query, (parents.pop(),) + self._extra + tuple(mapping))
+            return
+        # a single multi-row UPSERT that only touches the parent column of existing rows
+        query = self._sql_upsert + ', '.join([self._sql_upsert_row] * len(mapping)) + self._sql_on_duplicate
+        args = []
+        for obj, parent in mapping.items():
+            args.extend(self._extra + (obj, parent, 1))
+        self._write(query, args)
+
+    def upsert_many(self, mapping):
+        if not mapping:
+            return
+        # a single multi-row UPSERT of both columns
+        query = self._sql_upsert + ', '.join([self._sql_upsert_row] * len(mapping)) + self._sql_on_duplicate_weight
+        args = []
+        for obj, (parent, weight) in mapping.items():
+            args.extend(self._extra + (obj, parent, weight))
+        self._write(query, args)
+
+    def parents_of(self, objects):
+        objects = tuple(objects)
+        if not objects:
+            return {}
+        query = self._sql_parents_of + '(%s)' % ', '.join(['%s'] * len(objects))
+        return dict((el['_id'], el['parent']) for el in self._fetch(query, self._extra + objects))
+
+    def children_of(self, objects):
+        objects = tuple(objects)
+        children = {}
+        if objects:
+            query = self._sql_children_of + '(%s)' % ', '.join(['%s'] * len(objects))
+            for el in self._fetch(query, self._extra + objects):
+                children.setdefault(el['parent'], []).append(el['_id'])
+        return children
 
     def inc_weight(self, obj, weight):
-        query = " UPDATE %s " % self.table
-        query += "SET weight = weight + %s "  # WHERE _id = %s"
-        query += self._sql_where(obj=True)
-        with self.db:
-            self.cur.execute(query, (weight, obj))
+        self._write(self._sql_inc_weight, (weight,) + self._extra + (obj,))
 
     def items(self):
-        self.cur.execute(self._sql_find_all)
-        res = {el.pop('_id'): el for el in self.cur.fetchall()}
+        res = {el.pop('_id'): el for el in self._fetch(self._sql_find_all, self._extra)}
         for el in res.items():
             yield el
 
     def iter_children(self):
-        query = " SELECT parent FROM %s " % self.table
-        if self.extra_fields:  # possibly include a WHERE clause
-            query += self._sql_where(obj=False)
-        query += "GROUP BY parent ORDER BY count(*) DESC"
-        with self.db:
-            self.cur.execute(query)
-            for parent in self.cur.fetchall():
-                parent = parent['parent']
-                query2 = " SELECT _id FROM %s " % self.table
-                if self.extra_fields:
-                    query2 += self._sql_where(obj=False) + ' AND parent = %s'
-                else:
-                    query2 += " WHERE parent = %s "
-                self.cur.execute(query2, (parent,))
-                yield list([m['_id'] for m in self.cur.fetchall()])
+        # a single query, the children of each parent come in a row
+        for parent, children in groupby(self._fetch(self._sql_children, self._extra), lambda el: el['parent']):
+            yield [el['_id'] for el in children]
+
+
+class SQLiteParents(Parents):
+    """
+    Handle disjoint sets, via an embedded sqlite database.
+
+    Writes are grouped in transactions, committed every `commit_every` writes,
+    on commit(), when leaving a `with` block, or at exit. Other connections only see
+    committed writes, and closing the connection first discards the pending ones.
+    """
+    def __init__(self, db, table=None, commit_every=1000, server_side_find=False):
+        """
+        Parameters:
+        -----------
+        :param db: an instance of sqlite3.Connection
+        :param table: a string representing the table in the db, created if it does not exist
+        :param commit_every: the number of writes grouped in a transaction
+        :param server_side_find: if True, resolve roots with a single recursive query
+        """
+        if not _is_sqlite(db):
+            raise TypeError('db must be a valid instance of sqlite3.Connection')
+
+        self.db = db
+        self.table = table
+        self.commit_every = commit_every
+        self.server_side_find = server_side_find
+        self._writes = 0
+        _commit_at_exit_later(self)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(_sqlite_create_table_query(table))
+        db.execute(_sqlite_create_index_query(table))
+        # queries are built once, so that sqlite reuses its prepared statements
+        self._sql_contains = 'SELECT 1 FROM %s WHERE _id = ?' % table
+        self._sql_find_obj = 'SELECT parent, weight FROM %s WHERE _id = ?' % table
+        self._sql_parent_of = 'SELECT parent FROM %s WHERE _id = ?' % table
+        self._sql_weight_of = 'SELECT weight FROM %s WHERE _id = ?' % table
+        self._sql_find_all = 'SELECT _id, parent, weight FROM %s' % table
+        self._sql_parents_of = 'SELECT _id, parent FROM %s WHERE _id IN (%%s)' % table
+        self._sql_children_of = 'SELECT _id, parent FROM %s WHERE parent IN (%%s) AND _id <> parent' % table
+        self._sql_move_to = 'UPDATE %s SET parent = ? WHERE _id IN (%%s)' % table
+        self._sql_find_path = ('WITH RECURSIVE path (_id, parent, depth) AS ('
+                               ' SELECT _id, parent, 0 FROM {0} WHERE _id = ?'
+                               ' UNION ALL'
+                               ' SELECT t._id, t.parent, path.depth + 1 FROM path JOIN {0} t ON t._id = path.parent'
+                               ' WHERE path._id <> path.parent)'
+                               ' SELECT _id FROM path ORDER BY depth').format(table)
+        self._sql_insert_obj = 'INSERT INTO %s (_id, parent, weight) VALUES (?, ?, 1)' % table
+        self._sql_upsert_obj = 'INSERT OR REPLACE INTO %s (_id, parent, weight) VALUES (?, ?, ?)' % table
+        self._sql_set_parent = 'UPDATE %s SET parent = ? WHERE _id = ?' % table
+        self._sql_inc_weight = 'UPDATE %s SET weight = weight + ? WHERE _id = ?' % table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commit()
+
+    def commit(self):
+        """ Commit the pending writes. """
+        self.db.commit()
+        self._writes = 0
+
+    def _written(self, count=1):
+        self._writes += count
+        if self._writes >= self.commit_every:
+            self.commit()
+
+    def _fetch_value(self, query, obj):
+        row = self.db.execute(query, (obj,)).fetchone()
+        if row is None:
+            raise KeyError(obj)
+        return row[0]
+
+    def __contains__(self, obj):
+        return self.db.execute(self._sql_contains, (obj,)).fetchone() is not None
+
+    def __getitem__(self, obj):
+        row = self.db.execute(self._sql_find_obj, (obj,)).fetchone()
+        if row is None:
+            return None
+        return {'_id': obj, 'parent': row[0], 'weight': row[1]}
+
+    def __setitem__(self, obj, parent):
+        if self.db.execute(self._sql_set_parent, (parent, obj)).rowcount == 0:
+            self.db.execute(self._sql_insert_obj, (obj, parent))
+        self._written()
+
+    def inc_weight(self, obj, weight):
+        self.db.execute(self._sql_inc_weight, (weight, obj))
+        self._written()
+
+    def parent_of(self, obj):
+        return self._fetch_value(self._sql_parent_of, obj)
+
+    def weight_of(self, obj):
+        return self._fetch_value(self._sql_weight_of, obj)
+
+    def find_path(self, obj):
+        if not self.server_side_find:
+            return Parents.find_path(self, obj)
+        path = [row[0] for row in self.db.execute(self._sql_find_path, (obj,)).fetchall()]
+        if not path:
+            raise KeyError(obj)
+        return path
+
+    def set_parents(self, mapping):
+        if not mapping:
+            return
+        parents = set(mapping.values())
+        if len(parents) == 1:
+            # e.g. a compressed path, set-based UPDATEs below the limit of 999 host parameters
+            parent, objects = parents.pop(), list(mapping)
+            for i in range(0, len(objects), 500):
+                chunk = objects[i:i + 500]
+                self.db.execute(self._sql_move_to % ', '.join(['?'] * len(chunk)), [parent] + chunk)
+        else:
+            self.db.executemany(self._sql_set_parent, [(parent, obj) for obj, parent in mapping.items()])
+        self._written(len(mapping))
+
+    def upsert_many(self, mapping):
+        if not mapping:
+            return
+        self.db.executemany(self._sql_upsert_obj, [(obj, parent, weight) for obj, (parent, weight) in mapping.items()])
+        self._written(len(mapping))
+
+    def parents_of(self, objects):
+        objects = list(objects)
+        parents = {}
+        # stay below the default limit of 999 host parameters per statement
+        for i in range(0, len(objects), 500):
+            chunk = objects[i:i + 500]
+            query = self._sql_parents_of % ', '.join(['?'] * len(chunk))
+            parents.update(self.db.execute(query, chunk).fetchall())
+        return parents
+
+    def children_of(self, objects):
+        objects = list(objects)
+        children = {}
+        for i in range(0, len(objects), 500):
+            chunk = objects[i:i + 500]
+            for obj, parent in self.db.execute(self._sql_children_of % ', '.join(['?'] * len(chunk)), chunk):
+                children.setdefault(parent, []).append(obj)
+        return children
+
+    def items(self):
+        for row in self.db.execute(self._sql_find_all).fetchall():
+            yield row[0], {'parent': row[1], 'weight': row[2]}
+
+    def iter_children(self):
+        children = {}
+        for row in self.db.execute(self._sql_find_all).fetchall():
+            children.setdefault(row[1], []).append(row[0])
+        return iter(children.values())
+
+
+_alive_sqlite_parents = None  # the SQLiteParents to commit at exit, a WeakSet built with the first one
+
+
+def _commit_at_exit_later(parents):
+    """ Commit the pending writes of `parents` at exit, if it is still alive. A single hook serves all of them. """
+    global _alive_sqlite_parents
+    if _alive_sqlite_parents is None:
+        import atexit
+        import weakref
+        _alive_sqlite_parents = weakref.WeakSet()
+        atexit.register(_commit_at_exit)
+    _alive_sqlite_parents.add(parents)
+
+
+def _commit_at_exit():
+    """ Commit the pending writes of the SQLiteParents that are still alive at exit. """
+    import sqlite3
+    for parents in list(_alive_sqlite_parents):
+        if parents._writes:
+            try:
+                parents.commit()
+            except sqlite3.ProgrammingError:  # the connection was closed, the writes are lost
+                pass
+
+
+def _sqlite_create_table_query(table):
+    """ Keys keep their python type, since sqlite columns without a type accept any value. """
+    return 'CREATE TABLE IF NOT EXISTS %s (_id NOT NULL PRIMARY KEY, parent NOT NULL, weight INTEGER NOT NULL)' % table
+
+
+def _sqlite_create_index_query(table):
+    """ The index on the parents, to find the children of an element. """
+    return 'CREATE INDEX IF NOT EXISTS {0}_parent ON {0} (parent)'.format(table)
 
 
 class MongoParents(Parents):
@@ -181,18 +647,20 @@ class MongoParents(Parents):
     use this class directly. Indeed, the class UnionFind already implements
     union-find features.
     """
-    def __init__(self, db, collection=None):
+    def __init__(self, db, collection=None, server_side_find=False):
         """
         Parameters:
         -----------
         :param db: an instance of pymongo.database.Database or None
         :param collection: a string representing the collection in the db or None
+        :param server_side_find: if True, resolve roots with a single $graphLookup aggregation
         """
-        if not isinstance(db, pymongo.database.Database):
+        if not _is_mongodb(db):
             raise TypeError('db must be a valid instance of pymongo.database.Database')
 
         self.db = db
         self.collection = collection
+        self.server_side_find = server_side_find
 
     def __contains__(self, obj):
         return self.db[self.collection].find({'_id': obj}, {'_id': 1}).count() > 0
@@ -210,6 +678,57 @@ class MongoParents(Parents):
             obj_el['parent'] = parent_el['_id']
         self.db[self.collection].save(obj_el)
 
+    def find_path(self, obj):
+        if not self.server_side_find:
+            return Parents.find_path(self, obj)
+        pipeline = [
+            {'$match': {'_id': obj}},
+            {'$graphLookup': {'from': self.collection, 'startWith': '$parent', 'connectFromField': 'parent',
+                              'connectToField': '_id', 'as': 'ancestors', 'depthField': 'depth'}},
+            {'$project': {'ancestors._id': 1, 'ancestors.depth': 1}},
+        ]
+        res = list(self.db[self.collection].aggregate(pipeline))
+        if not res:
+            raise KeyError(obj)
+        path = [obj]
+        for el in sorted(res[0]['ancestors'], key=lambda el: el['depth']):
+            if el['_id'] != path[-1]:  # the root is its own parent
+                path.append(el['_id'])
+        return path
+
+    def set_parents(self, mapping):
+        if not mapping:
+            return
+        parents = set(mapping.values())
+        if len(parents) == 1:  # e.g. a compressed path
+            self.db[self.collection].update_many({'_id': {'$in': list(mapping)}}, {'$set': {'parent': parents.pop()}})
+            return
+        import pymongo
+        requests = [pymongo.UpdateOne({'_id': obj}, {'$set': {'parent': parent}}) for obj, parent in mapping.items()]
+        self.db[self.collection].bulk_write(requests, ordered=False)
+
+    def upsert_many(self, mapping):
+        if not mapping:
+            return
+        import pymongo
+        requests = [pymongo.ReplaceOne({'_id': obj}, {'_id': obj, 'parent': parent, 'weight': weight}, upsert=True)
+                    for obj, (parent, weight) in mapping.items()]
+        self.db[self.collection].bulk_write(requests, ordered=False)
+
+    def parents_of(self, objects):
+        objects = list(objects)
+        if not objects:
+            return {}
+        cursor = self.db[self.collection].find({'_id': {'$in': objects}}, {'parent': 1})
+        return dict((el['_id'], el['parent']) for el in cursor)
+
+    def children_of(self, objects):
+        children = {}
+        for el in self.db[self.collection].find({'parent': {'$in': list(objects)}}, {'parent': 1}):
+            if el['_id'] != el['parent']:
+                children.setdefault(el['parent'], []).append(el['_id'])
+        return children
+
     def inc_weight(self, obj, weight):
         obj_el = self.db[self.collection].find_one({'_id': obj})
         obj_el['weight'] += weight
@@ -220,16 +739,18 @@ class MongoParents(Parents):
         for el in res.items():
             yield el
 
-    def iter_children(self):
-        raise NotImplementedError('TODO')
 
 
 class DictParents(Parents):
     """
     Handle disjoint sets, using built-in python dictionaries
     """
+    tracks_members = True
+
     def __init__(self):
         self._parents = {}
+        self._next = {}  # circular lists of the members of each set
+        self._dirty = None  # elements changed since the last consolidation, tracked from the first one
 
     def __contains__(self, obj):
         return obj in self._parents
@@ -240,26 +761,1429 @@ class DictParents(Parents):
     def __setitem__(self, obj, parent):
         if obj not in self._parents:
             self._parents[obj] = {'parent': parent, 'weight': 1}
+            self._next[obj] = obj
         else:
             self._parents[obj]['parent'] = parent
+        if self._dirty is not None:
+            self._dirty.add(obj)
 
     def inc_weight(self, obj, weight):
         self._parents[obj]['weight'] += weight
+        if self._dirty is not None:
+            self._dirty.add(obj)
+
+    # direct access to the dicts, instead of the generic fallbacks
+
+    def parent_of(self, obj):
+        return self._parents[obj]['parent']
+
+    def weight_of(self, obj):
+        return self._parents[obj]['weight']
+
+    def find_path(self, obj):
+        parents = self._parents
+        path = [obj]
+        root = parents[obj]['parent']
+        while root != path[-1]:
+            path.append(root)
+            root = parents[root]['parent']
+        return path
+
+    def set_parents(self, mapping):
+        parents = self._parents
+        for obj, parent in mapping.items():
+            parents[obj]['parent'] = parent
+        if self._dirty is not None:
+            self._dirty.update(mapping)
+
+    def upsert_many(self, mapping):
+        parents = self._parents
+        for obj, (parent, weight) in mapping.items():
+            if obj not in parents:
+                self._next[obj] = obj
+            parents[obj] = {'parent': parent, 'weight': weight}
+        if self._dirty is not None:
+            self._dirty.update(mapping)
+
+    def parents_of(self, objects):
+        parents = self._parents
+        return dict((obj, parents[obj]['parent']) for obj in objects if obj in parents)
+
+    def link_members(self, root, other):
+        # swapping the successors splices two circular lists into one
+        self._next[root], self._next[other] = self._next[other], self._next[root]
+
+    def unlink_member(self, obj):
+        prev = obj
+        while self._next[prev] != obj:
+            prev = self._next[prev]
+        self._next[prev], self._next[obj] = self._next[obj], obj
+        return prev
+
+    def iter_members(self, obj):
+        member = obj
+        while True:
+            yield member
+            member = self._next[member]
+            if member == obj:
+                return
 
     def items(self):
         for el in self._parents.items():
             yield el
 
     def iter_children(self):
-        raise NotImplementedError('TODO')
+        for obj, el in self._parents.items():
+            if el['parent'] == obj:
+                yield list(self.iter_members(obj))
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        """ Write the disjoint sets to a database. When `incremental` is True, only the elements
+        changed since the last consolidation are upserted, and the other rows are left untouched.
+        Changes are only tracked from the first consolidation on, which upserts every element.
+        """
+        if incremental and self._dirty is not None:
+            elements = ((obj, self._parents[obj]) for obj in self._dirty)
+        else:
+            elements = self._parents
+        count = _consolidate(db, collection, elements, incremental, **extra_fields)
+        self._dirty = set()
+        return count
+
+
+class ArrayParents(Parents):
+    """
+    Handle disjoint sets, using flat typed arrays for parents and weights.
+
+    Elements are expected to be non-negative integers, ideally dense in 0..n-1.
+    Arrays grow automatically as new ids show up. When `interned` is True,
+    any hashable object can be used: each one is mapped once to the next free id.
+    """
+    tracks_members = True
+
+    def __init__(self, size=0, interned=False):
+        """
+        Parameters:
+        -----------
+        :param size: the number of ids to pre-allocate
+        :param interned: if True, map arbitrary hashable objects to integer ids
+        """
+        self._parent = array('l', [-1]) * size
+        self._weight = array('l', [0]) * size
+        self._next = array('l', [-1]) * size  # circular lists of the members of each set
+        self.interned = interned
+        if interned:
+            self._ids = {}
+            self._keys = []
+
+    def _grow(self, obj):
+        """ Make room for the id `obj`, at least doubling the arrays to amortize reallocations. """
+        missing = max(obj + 1, 2 * len(self._parent), 16) - len(self._parent)
+        self._parent.extend(array('l', [-1]) * missing)
+        self._weight.extend(array('l', [0]) * missing)
+        self._next.extend(array('l', [-1]) * missing)
+
+    def __contains__(self, obj):
+        if self.interned:
+            return obj in self._ids
+        return 0 <= obj < len(self._parent) and self._parent[obj] != -1
+
+    def __getitem__(self, obj):
+        if obj not in self:
+            raise KeyError(obj)
+        return {'parent': self.parent_of(obj), 'weight': self.weight_of(obj)}
+
+    def __setitem__(self, obj, parent):
+        if not self.interned:
+            if obj < 0:
+                raise ValueError('ids must be non-negative integers')
+            if obj >= len(self._parent):
+                self._grow(obj)
+            if self._parent[obj] == -1:
+                self._weight[obj] = 1
+                self._next[obj] = obj
+            self._parent[obj] = parent
+        elif obj in self._ids:
+            self._parent[self._ids[obj]] = self._ids[parent]
+        else:
+            i = self._ids[obj] = len(self._keys)
+            self._keys.append(obj)
+            self._parent.append(i if parent == obj else self._ids[parent])
+            self._weight.append(1)
+            self._next.append(i)
+
+    def inc_weight(self, obj, weight):
+        if self.interned:
+            obj = self._ids[obj]
+        self._weight[obj] += weight
+
+    def parent_of(self, obj):
+        if self.interned:
+            return self._keys[self._parent[self._ids[obj]]]
+        return self._parent[obj]
+
+    def weight_of(self, obj):
+        if self.interned:
+            return self._weight[self._ids[obj]]
+        return self._weight[obj]
+
+    def find_path(self, obj):
+        # walk up the ids, mapping them back to keys only once the path is known
+        parent = self._parent
+        path = [self._ids[obj] if self.interned else obj]
+        root = parent[path[0]]
+        while root != path[-1]:
+            path.append(root)
+            root = parent[root]
+        if self.interned:
+            keys = self._keys
+            return [keys[i] for i in path]
+        return path
+
+    def parents_of(self, objects):
+        parent = self._parent
+        if not self.interned:
+            return dict((obj, parent[obj]) for obj in objects if obj in self)
+        ids, keys = self._ids, self._keys
+        return dict((obj, keys[parent[ids[obj]]]) for obj in objects if obj in ids)
+
+    def link_members(self, root, other):
+        if self.interned:
+            root, other = self._ids[root], self._ids[other]
+        # swapping the successors splices two circular lists into one
+        self._next[root], self._next[other] = self._next[other], self._next[root]
+
+    def unlink_member(self, obj):
+        i = prev = self._ids[obj] if self.interned else obj
+        while self._next[prev] != i:
+            prev = self._next[prev]
+        self._next[prev], self._next[i] = self._next[i], i
+        return self._keys[prev] if self.interned else prev
+
+    def iter_members(self, obj):
+        start = i = self._ids[obj] if self.interned else obj
+        while True:
+            yield self._keys[i] if self.interned else i
+            i = self._next[i]
+            if i == start:
+                return
+
+    def items(self):
+        if self.interned:
+            for i, obj in enumerate(self._keys):
+                yield obj, {'parent': self._keys[self._parent[i]], 'weight': self._weight[i]}
+        else:
+            for obj, parent in enumerate(self._parent):
+                if parent != -1:
+                    yield obj, {'parent': parent, 'weight': self._weight[obj]}
+
+    def iter_children(self):
+        for obj, el in self.items():
+            if el['parent'] == obj:
+                yield list(self.iter_members(obj))
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        if incremental:
+            raise NotImplementedError('changed elements are not tracked by ArrayParents')
+        return _consolidate(db, collection, self.items(), **extra_fields)
+
+
+class CachedParents(Parents):
+    """
+    Keep the most recently used elements of another Parents in memory.
+
+    Reads are served from a bounded LRU cache. Updates are buffered and written
+    back to the wrapped Parents in a batch when a modified element is evicted,
+    when flush() is called, or when leaving a `with` block. Other writers of the
+    same collection/table are not seen while their elements stay cached.
+    When the wrapped Parents tracks members, the splices of the member lists are
+    buffered as well, and replayed after the elements are written back.
+    """
+    def __init__(self, parents, size=100000):
+        """
+        Parameters:
+        -----------
+        :param parents: an instance of Parents to wrap, e.g., MongoParents or MySQLParents
+        :param size: the maximum number of elements kept in memory
+        """
+        self.parents = parents
+        self.size = size
+        self._cache = OrderedDict()
+        self._stored = {}  # modified element -> (parent, weight) as stored in self.parents, None if new
+        self._links = []  # buffered link_members() calls, in order
+        self.hits = self.misses = self.evictions = self.flushes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _get(self, obj):
+        """ Return the cached element `obj`, loading it from the wrapped Parents on a miss. """
+        if obj in self._cache:
+            self.hits += 1
+            el = self._cache[obj] = self._cache.pop(obj)  # most recently used go last
+            return el
+        self.misses += 1
+        try:
+            el = self.parents[obj]
+        except KeyError:
+            el = None
+        if el is None:
+            return None
+        el = self._cache[obj] = {'parent': el['parent'], 'weight': el['weight']}
+        self._evict()
+        return el
+
+    def _evict(self):
+        """ Drop the least recently used elements beyond the cache size, writing back updates first. """
+        while len(self._cache) > self.size:
+            oldest = next(iter(self._cache))
+            if oldest in self._stored:
+                self.flush()
+            del self._cache[oldest]
+            self.evictions += 1
+
+    def __contains__(self, obj):
+        return self._get(obj) is not None
+
+    def __getitem__(self, obj):
+        el = self._get(obj)
+        if el is None:
+            raise KeyError(obj)
+        return dict(el)
+
+    def __setitem__(self, obj, parent):
+        el = self._get(obj)
+        if el is None:
+            self._cache[obj] = {'parent': parent, 'weight': 1}
+            self._stored[obj] = None
+            self._evict()
+        else:
+            if obj not in self._stored:
+                self._stored[obj] = (el['parent'], el['weight'])
+            el['parent'] = parent
+
+    def inc_weight(self, obj, weight):
+        el = self._get(obj)
+        if obj not in self._stored:
+            self._stored[obj] = (el['parent'], el['weight'])
+        el['weight'] += weight
+
+    def parent_of(self, obj):
+        return self._get(obj)['parent']
+
+    def weight_of(self, obj):
+        return self._get(obj)['weight']
+
+    def parents_of(self, objects):
+        parents = {}
+        missing = []
+        for obj in objects:
+            if obj in self._cache:
+                self.hits += 1
+                el = self._cache[obj] = self._cache.pop(obj)
+                parents[obj] = el['parent']
+            else:
+                missing.append(obj)
+        if missing:
+            # a single call to the wrapped Parents for every miss. Weights are not
+            # fetched, so misses are not cached. Modified elements are always cached
+            self.misses += len(missing)
+            parents.update(self.parents.parents_of(missing))
+        return parents
+
+    def flush(self):
+        """ Write every buffered update back to the wrapped Parents, with a single upsert. """
+        if not self._stored and not self._links:
+            return
+        changed = {}
+        for obj, stored in self._stored.items():
+            el = self._cache[obj]
+            if stored != (el['parent'], el['weight']):
+                changed[obj] = (el['parent'], el['weight'])
+        self.parents.upsert_many(changed)
+        for root, other in self._links:  # the elements exist in the wrapped Parents by now
+            self.parents.link_members(root, other)
+        self._stored.clear()
+        del self._links[:]
+        self.flushes += 1
+
+    def cache_info(self):
+        """ Return a dict with the cache counters. """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'flushes': self.flushes, 'size': len(self._cache), 'dirty': len(self._stored)}
+
+    def items(self):
+        self.flush()
+        return self.parents.items()
+
+    def children_of(self, objects):
+        self.flush()
+        return self.parents.children_of(objects)
+
+    @property
+    def tracks_members(self):
+        return self.parents.tracks_members
+
+    def link_members(self, root, other):
+        if self.parents.tracks_members:
+            self._links.append((root, other))
+
+    def unlink_member(self, obj):
+        self.flush()
+        return self.parents.unlink_member(obj)
+
+    def iter_members(self, obj):
+        self.flush()
+        return self.parents.iter_members(obj)
+
+    def iter_children(self):
+        self.flush()
+        return self.parents.iter_children()
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        self.flush()
+        return self.parents.consolidate(db, collection, incremental, **extra_fields)
+
+
+class Keys(object):
+    """
+    Abstract class to define the dictionaries that map keys to integer ids, stored
+    in the database next to the disjoint sets. Ids never change once assigned, so
+    both directions of the mapping are cached in memory.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self._ids = {}
+        self._keys = {}
+
+    @abc.abstractmethod
+    def _fetch_ids(self, keys, create):
+        """ Return a dict mapping each of the `keys` to its id, assigning new ids to unknown keys if `create`. """
+        return
+
+    @abc.abstractmethod
+    def _fetch_keys(self, ids):
+        """ Return a dict mapping each of the `ids` to its key. """
+        return
+
+    def _remember(self, ids):
+        for key, i in ids.items():
+            self._ids[key] = i
+            self._keys[i] = key
+
+    def ids_of(self, keys, create=False):
+        """ Return a dict mapping each of the `keys` to its id, fetching the missing ones with a single query. """
+        keys = list(keys)
+        missing = [key for key in OrderedDict.fromkeys(keys) if key not in self._ids]
+        if missing:
+            self._remember(self._fetch_ids(missing, create))
+        return dict((key, self._ids[key]) for key in keys if key in self._ids)
+
+    def keys_of(self, ids):
+        """ Return a dict mapping each of the `ids` to its key, fetching the missing ones with a single query. """
+        ids = list(ids)
+        missing = [i for i in OrderedDict.fromkeys(ids) if i not in self._keys]
+        if missing:
+            self._remember(dict((key, i) for i, key in self._fetch_keys(missing).items()))
+        return dict((i, self._keys[i]) for i in ids)
+
+    def id_of(self, key, create=False):
+        """ Return the id of `key`, or None if it has none. """
+        if key in self._ids:
+            return self._ids[key]
+        return self.ids_of([key], create).get(key)
+
+    def key_of(self, i):
+        if i in self._keys:
+            return self._keys[i]
+        return self.keys_of([i])[i]
+
+
+class MySQLKeys(Keys):
+    """
+    Map keys to integer ids in the mysql table `<table>_keys`, created if it does not exist.
+    """
+    def __init__(self, db, table):
+        Keys.__init__(self)
+        self.pool = _mysql_pool(db)
+        self.table = table + '_keys'
+        self.pool.execute('CREATE TABLE IF NOT EXISTS %s (id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+                          '_key VARCHAR(100) NOT NULL, UNIQUE KEY (_key)) '
+                          'DEFAULT CHARACTER SET utf8 COLLATE utf8_bin' % self.table, write=True)
+
+    def _fetch_ids(self, keys, create):
+        placeholders = ', '.join(['%s'] * len(keys))
+        if create:
+            self.pool.execute('INSERT IGNORE INTO %s (_key) VALUES %s' % (
+                self.table, ', '.join(['(%s)'] * len(keys))), keys, write=True)
+        return dict(self.pool.execute('SELECT _key, id FROM %s WHERE _key IN (%s)' % (self.table, placeholders), keys))
+
+    def _fetch_keys(self, ids):
+        return dict(self.pool.execute('SELECT id, _key FROM %s WHERE id IN (%s)' % (
+            self.table, ', '.join(['%s'] * len(ids))), ids))
+
+
+class SQLiteKeys(Keys):
+    """
+    Map keys to integer ids in the sqlite table `<table>_keys`, created if it does not exist.
+    """
+    def __init__(self, db, table):
+        Keys.__init__(self)
+        self.db = db
+        self.table = table + '_keys'
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, _key NOT NULL UNIQUE)' % self.table)
+
+    def _select(self, query, values):
+        res = {}
+        # stay below the default limit of 999 host parameters per statement
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            res.update(self.db.execute(query % ', '.join(['?'] * len(chunk)), chunk).fetchall())
+        return res
+
+    def _fetch_ids(self, keys, create):
+        if create:
+            self.db.executemany('INSERT OR IGNORE INTO %s (_key) VALUES (?)' % self.table, [(key,) for key in keys])
+        return self._select('SELECT _key, id FROM %s WHERE _key IN (%%s)' % self.table, keys)
+
+    def _fetch_keys(self, ids):
+        return self._select('SELECT id, _key FROM %s WHERE id IN (%%s)' % self.table, ids)
+
+
+class MongoKeys(Keys):
+    """
+    Map keys to integer ids in the mongodb collection `<collection>_keys`.
+    Ids are reserved in blocks from a counter in the collection `<collection>_seq`.
+    """
+    def __init__(self, db, collection):
+        Keys.__init__(self)
+        self.db = db
+        self.collection = collection + '_keys'
+        self.sequence = collection + '_seq'
+        self.db[self.collection].create_index('id', unique=True)
+
+    def _fetch_ids(self, keys, create):
+        import pymongo
+        coll = self.db[self.collection]
+        if create:
+            known = set(el['_id'] for el in coll.find({'_id': {'$in': keys}}, {'_id': 1}))
+            new = [key for key in keys if key not in known]
+            if new:
+                seq = self.db[self.sequence].find_one_and_update(
+                    {'_id': self.collection}, {'$inc': {'seq': len(new)}}, upsert=True,
+                    return_document=pymongo.ReturnDocument.AFTER)['seq']
+                try:
+                    coll.insert_many([{'_id': key, 'id': seq - len(new) + 1 + i} for i, key in enumerate(new)],
+                                     ordered=False)
+                except pymongo.errors.BulkWriteError:
+                    pass  # keys added by another writer in the meantime keep their id
+        return dict((el['_id'], el['id']) for el in coll.find({'_id': {'$in': keys}}))
+
+    def _fetch_keys(self, ids):
+        return dict((el['id'], el['_id']) for el in self.db[self.collection].find({'id': {'$in': ids}}))
+
+
+def _keys_for(db, collection):
+    """ Return the dictionary of interned keys that matches the type of `db`. """
+    if _is_sqlite(db):
+        return SQLiteKeys(db, collection)
+    if _is_mongodb(db):
+        return MongoKeys(db, collection)
+    return MySQLKeys(db, collection)
+
+
+class InternedParents(Parents):
+    """
+    Store the disjoint sets of another Parents as integer ids, mapped once to the
+    original keys by a Keys dictionary. Parent links and indexes in the database
+    hold integers instead of repeating the keys, and callers only see keys.
+    """
+    def __init__(self, parents, keys):
+        """
+        Parameters:
+        -----------
+        :param parents: an instance of Parents to wrap, e.g., MongoParents or MySQLParents
+        :param keys: an instance of Keys, e.g., MySQLKeys(db, table)
+        """
+        self.parents = parents
+        self.keys = keys
+
+    @property
+    def server_side_find(self):
+        return self.parents.server_side_find
+
+    def _element(self, el):
+        if el is None:
+            return None
+        return {'parent': self.keys.key_of(el['parent']), 'weight': el['weight']}
+
+    def __contains__(self, obj):
+        i = self.keys.id_of(obj)
+        return i is not None and i in self.parents
+
+    def __getitem__(self, obj):
+        i = self.keys.id_of(obj)
+        if i is None:
+            return None
+        return self._element(self.parents[i])
+
+    def __setitem__(self, obj, parent):
+        ids = self.keys.ids_of([obj, parent], create=True)
+        self.parents[ids[obj]] = ids[parent]
+
+    def inc_weight(self, obj, weight):
+        self.parents.inc_weight(self.keys.id_of(obj), weight)
+
+    def parent_of(self, obj):
+        return self.keys.key_of(self.parents.parent_of(self.keys.id_of(obj)))
+
+    def weight_of(self, obj):
+        return self.parents.weight_of(self.keys.id_of(obj))
+
+    def find_path(self, obj):
+        if not self.server_side_find:
+            return Parents.find_path(self, obj)
+        i = self.keys.id_of(obj)
+        if i is None:
+            raise KeyError(obj)
+        path = self.parents.find_path(i)
+        keys = self.keys.keys_of(path)
+        return [keys[i] for i in path]
+
+    def set_parents(self, mapping):
+        if not mapping:
+            return
+        ids = self.keys.ids_of(list(mapping) + list(mapping.values()))
+        self.parents.set_parents(dict((ids[obj], ids[parent]) for obj, parent in mapping.items()))
+
+    def upsert_many(self, mapping):
+        if not mapping:
+            return
+        ids = self.keys.ids_of(list(mapping) + [parent for parent, weight in mapping.values()], create=True)
+        self.parents.upsert_many(dict((ids[obj], (ids[parent], weight)) for obj, (parent, weight) in mapping.items()))
+
+    def parents_of(self, objects):
+        ids = self.keys.ids_of(objects)
+        parents = self.parents.parents_of(list(ids.values()))
+        keys = self.keys.keys_of(list(parents) + list(parents.values()))
+        return dict((keys[i], keys[parent]) for i, parent in parents.items())
+
+    def children_of(self, objects):
+        ids = self.keys.ids_of(objects)
+        children = self.parents.children_of(list(ids.values()))
+        keys = self.keys.keys_of(list(children) + [i for c in children.values() for i in c])
+        return dict((keys[parent], [keys[i] for i in c]) for parent, c in children.items())
+
+    def items(self):
+        elements = list(self.parents.items())
+        keys = self.keys.keys_of([i for i, el in elements] + [el['parent'] for i, el in elements])
+        for i, el in elements:
+            yield keys[i], {'parent': keys[el['parent']], 'weight': el['weight']}
+
+    def iter_children(self):
+        for children in self.parents.iter_children():
+            keys = self.keys.keys_of(children)
+            yield [keys[i] for i in children]
+
+
+class ShardedParents(Parents):
+    """
+    Spread the disjoint sets across several Parents, e.g., one collection, table or
+    connection each, by a hash of the keys. Parents may live in a shard other than
+    their children, and paths are followed from shard to shard.
+    """
+    def __init__(self, shards):
+        """
+        Parameters:
+        -----------
+        :param shards: a list of instances of Parents, which must always be given in the same order
+        """
+        self.shards = list(shards)
+
+    def _shard(self, obj):
+        return self.shards[_shard_of(obj, len(self.shards))]
+
+    def _group(self, objects):
+        """ Return a dict mapping the index of each shard to the list of its objects """
+        groups = {}
+        n = len(self.shards)
+        for obj in objects:
+            groups.setdefault(_shard_of(obj, n), []).append(obj)
+        return groups
+
+    def __contains__(self, obj):
+        return obj in self._shard(obj)
+
+    def __getitem__(self, obj):
+        return self._shard(obj)[obj]
+
+    def __setitem__(self, obj, parent):
+        shard = self._shard(obj)
+        if obj not in shard:
+            shard[obj] = obj
+            if parent == obj:
+                return
+        # the parent may be in another shard, where the engine could not look it up
+        shard.set_parents({obj: parent})
+
+    def inc_weight(self, obj, weight):
+        self._shard(obj).inc_weight(obj, weight)
+
+    def parent_of(self, obj):
+        return self._shard(obj).parent_of(obj)
+
+    def weight_of(self, obj):
+        return self._shard(obj).weight_of(obj)
+
+    def set_parents(self, mapping):
+        for i, objects in self._group(mapping).items():
+            self.shards[i].set_parents(dict((obj, mapping[obj]) for obj in objects))
+
+    def upsert_many(self, mapping):
+        for i, objects in self._group(mapping).items():
+            self.shards[i].upsert_many(dict((obj, mapping[obj]) for obj in objects))
+
+    def parents_of(self, objects):
+        parents = {}
+        for i, objects in self._group(objects).items():
+            parents.update(self.shards[i].parents_of(objects))
+        return parents
+
+    def children_of(self, objects):
+        # children may live in any shard
+        objects = list(objects)
+        children = {}
+        for shard in self.shards:
+            for parent, c in shard.children_of(objects).items():
+                children.setdefault(parent, []).extend(c)
+        return children
+
+    def items(self):
+        for shard in self.shards:
+            for item in shard.items():
+                yield item
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        """ Write each shard to its own database in the list `db`, in parallel, or to the
+        collection/table `<collection>_<i>` of a single database, one at a time since
+        connections can not be shared by threads. Return the number of elements.
+        """
+        def consolidate_shard(shard, target):
+            if hasattr(shard, 'consolidate'):
+                return shard.consolidate(target[0], target[1], incremental, **extra_fields)
+            return _consolidate(target[0], target[1], shard.items(), incremental, **extra_fields)
+
+        if not isinstance(db, (list, tuple)):
+            return sum(consolidate_shard(shard, (db, '%s_%d' % (collection, i))) for i, shard in enumerate(self.shards))
+        if len(db) != len(self.shards):
+            raise ValueError('one database per shard is needed')
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(len(self.shards))
+        try:
+            return sum(pool.map(lambda args: consolidate_shard(*args), zip(self.shards, [(shard_db, collection) for shard_db in db])))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _shard_of(obj, n):
+    """ Return the shard of the object among `n`, the same on every run and python version. """
+    import zlib
+    if isinstance(obj, (str, text_type)):
+        data = _encode_key(b's', obj)
+    elif isinstance(obj, integer_types) and not isinstance(obj, bool):
+        data = str(obj).encode('ascii')
+    else:
+        import pickle
+        data = pickle.dumps(obj, 2)
+    return (zlib.crc32(data) & 0xffffffff) % n
+
+
+class TieredParents(Parents):
+    """
+    Handle disjoint sets larger than the memory, keeping the most recently used
+    elements in memory and spilling the others to a local file.
+
+    At most `memory_nodes` elements are kept in memory. Beyond that, the least
+    recently used ones are moved to disk in batches, and roots, which every find
+    in their set ends at, are the last to go. Elements read back from disk keep
+    their copy there, so that they are only written again if they change.
+    The file is an sqlite database used as a key-value store, with pickled keys.
+    """
+    def __init__(self, path, memory_nodes=1000000):
+        """
+        Parameters:
+        -----------
+        :param path: the file where elements are spilled, replaced if it exists
+        :param memory_nodes: the maximum number of elements kept in memory
+        """
+        import sqlite3
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.memory_nodes = memory_nodes
+        self._hot = OrderedDict()  # object -> [parent, weight, changed since read from disk]
+        self.faults = self.spills = 0
+        self.db = sqlite3.connect(path)
+        # a scratch file: durability is not needed
+        self.db.execute('PRAGMA journal_mode=OFF')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE nodes (key BLOB PRIMARY KEY, parent BLOB NOT NULL, weight INTEGER NOT NULL) '
+                        'WITHOUT ROWID')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _get(self, obj):
+        """ Return the element `obj` in memory, reading it from disk if needed, or None if it is unknown. """
+        el = self._hot.pop(obj, None)
+        if el is not None:
+            self._hot[obj] = el  # most recently used go last
+            return el
+        row = self.db.execute('SELECT parent, weight FROM nodes WHERE key = ?', (_pickled(obj),)).fetchone()
+        if row is None:
+            return None
+        self.faults += 1
+        import pickle
+        el = self._hot[obj] = [pickle.loads(bytes(row[0])), row[1], False]
+        self._spill()
+        return el
+
+    def _spill(self):
+        """ Move the least recently used elements to disk, down to 7/8 of the memory limit, sparing roots. """
+        if len(self._hot) <= self.memory_nodes:
+            return
+        need = len(self._hot) - max(self.memory_nodes - self.memory_nodes // 8, 1)
+        # the most recently used element is never spilled, callers may be about to change it
+        candidates = list(islice(self._hot, min(4 * need, len(self._hot) - 1)))
+        victims = [obj for obj in candidates if self._hot[obj][0] != obj][:need]
+        if len(victims) < need:
+            chosen = set(victims)
+            victims.extend(islice((obj for obj in self._hot if obj not in chosen), need - len(victims)))
+        rows = []
+        for obj in victims:
+            el = self._hot.pop(obj)
+            if el[2]:
+                rows.append((_pickled(obj), _pickled(el[0]), el[1]))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO nodes (key, parent, weight) VALUES (?, ?, ?)', rows)
+        self.spills += len(victims)
+
+    def __contains__(self, obj):
+        return self._get(obj) is not None
+
+    def __getitem__(self, obj):
+        el = self._get(obj)
+        if el is None:
+            raise KeyError(obj)
+        return {'parent': el[0], 'weight': el[1]}
+
+    def __setitem__(self, obj, parent):
+        el = self._get(obj)
+        if el is None:
+            self._hot[obj] = [parent, 1, True]
+            self._spill()
+        else:
+            el[0] = parent
+            el[2] = True
+
+    def inc_weight(self, obj, weight):
+        el = self._get(obj)
+        el[1] += weight
+        el[2] = True
+
+    def parent_of(self, obj):
+        return self._get(obj)[0]
+
+    def weight_of(self, obj):
+        return self._get(obj)[1]
+
+    def items(self):
+        hot = list(self._hot.items())
+        for obj, el in hot:
+            yield obj, {'parent': el[0], 'weight': el[1]}
+        hot = set(obj for obj, el in hot)
+        import pickle
+        import sqlite3
+        # read the file in pages, since finds may move elements while iterating
+        last = b''
+        while True:
+            rows = self.db.execute('SELECT key, parent, weight FROM nodes WHERE key > ? ORDER BY key LIMIT 10000',
+                                   (sqlite3.Binary(last),)).fetchall()
+            if not rows:
+                return
+            for key, parent, weight in rows:
+                obj = pickle.loads(bytes(key))
+                if obj in hot:
+                    continue
+                el = self._hot.get(obj)
+                if el is not None:  # read back since, possibly changed
+                    yield obj, {'parent': el[0], 'weight': el[1]}
+                else:
+                    yield obj, {'parent': pickle.loads(bytes(parent)), 'weight': weight}
+            last = bytes(rows[-1][0])
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        if incremental:
+            raise NotImplementedError('changed elements are not tracked by TieredParents')
+        return _consolidate(db, collection, self.items(), **extra_fields)
+
+
+def _pickled(obj):
+    """ Pickle the object as a blob, with a protocol that both python 2 and 3 read. """
+    import pickle
+    import sqlite3
+    return sqlite3.Binary(pickle.dumps(obj, 2))
+
+
+class SnapshotParents(Parents):
+    """
+    Handle disjoint sets saved with UnionFind.save(), reading them straight from a memory map.
+
+    Nothing is parsed when the file is opened. Elements are looked up with a binary
+    search on the sorted key table and decoded on demand. Changes are kept in memory,
+    and the file is never modified.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+        -----------
+        :param path: the path of a file written by UnionFind.save()
+        """
+        import mmap
+        import struct
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, kind, self._n, self.journal_seq = struct.unpack_from(_SNAPSHOT_HEADER, self._map, 0)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a UnionFind snapshot' % path)
+        self._kind = kind
+        self._unpack_int64 = struct.Struct('<q').unpack_from
+        self._parents_at = struct.calcsize(_SNAPSHOT_HEADER)
+        self._weights_at = self._parents_at + 8 * self._n
+        self._keys_at = self._weights_at + 8 * self._n  # keys, or offsets of the encoded keys
+        self._blob_at = self._keys_at + 8 * (self._n + 1)
+        self._overlay = {}  # elements changed or added since the snapshot was opened
+
+    def close(self):
+        self._map.close()
+
+    def _int64(self, at, i):
+        return self._unpack_int64(self._map, at + 8 * i)[0]
+
+    def _encoded(self, i):
+        start = self._int64(self._keys_at, i)
+        return self._map[self._blob_at + start:self._blob_at + self._int64(self._keys_at, i + 1)]
+
+    def _key(self, i):
+        if self._kind == b'i':
+            return self._int64(self._keys_at, i)
+        return _decode_key(self._kind, self._encoded(i))
+
+    def _index(self, obj):
+        """ Return the position of `obj` in the key table, or -1. """
+        if self._kind == b'i':
+            if not isinstance(obj, integer_types) or isinstance(obj, bool):
+                return -1
+            key, read = obj, lambda i: self._int64(self._keys_at, i)
+        else:
+            import pickle
+            try:
+                key = _encode_key(self._kind, obj)
+            except (TypeError, UnicodeError, pickle.PicklingError):
+                return -1
+            read = self._encoded
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if read(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._n and read(lo) == key else -1
+
+    def _get(self, obj):
+        if obj in self._overlay:
+            return self._overlay[obj]
+        i = self._index(obj)
+        if i < 0:
+            return None
+        return {'parent': self._key(self._int64(self._parents_at, i)), 'weight': self._int64(self._weights_at, i)}
+
+    def __contains__(self, obj):
+        return obj in self._overlay or self._index(obj) >= 0
+
+    def __getitem__(self, obj):
+        el = self._get(obj)
+        if el is None:
+            raise KeyError(obj)
+        return el
+
+    def __setitem__(self, obj, parent):
+        el = self._get(obj)
+        if el is None:
+            self._overlay[obj] = {'parent': parent, 'weight': 1}
+        else:
+            el['parent'] = parent
+            self._overlay[obj] = el
+
+    def inc_weight(self, obj, weight):
+        el = self[obj]
+        el['weight'] += weight
+        self._overlay[obj] = el
+
+    def items(self):
+        for i in range(self._n):
+            obj = self._key(i)
+            if obj not in self._overlay:
+                yield obj, {'parent': self._key(self._int64(self._parents_at, i)),
+                            'weight': self._int64(self._weights_at, i)}
+        for el in self._overlay.items():
+            yield el
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        if incremental:
+            raise NotImplementedError('changed elements are not tracked by SnapshotParents')
+        return _consolidate(db, collection, self.items(), **extra_fields)
+
+
+def _snapshot_kind(keys):
+    """ Return how the keys are stored: b'i' for 64-bit integers, b's' for strings, b'p' for pickles. """
+    if all(isinstance(k, integer_types) and not isinstance(k, bool) and -2 ** 63 <= k < 2 ** 63 for k in keys):
+        return b'i'
+    if all(isinstance(k, (str, text_type)) for k in keys):
+        return b's'
+    return b'p'
+
+
+def _encode_key(kind, obj):
+    if kind == b's':
+        if not isinstance(obj, (str, text_type)):
+            raise TypeError('not a string')
+        return obj.encode('utf-8') if isinstance(obj, text_type) else obj
+    import pickle
+    return pickle.dumps(obj, 2)
+
+
+def _decode_key(kind, data):
+    if kind == b's':
+        return data.decode('utf-8')
+    import pickle
+    return pickle.loads(data)
+
 
-    def consolidate(self, db, collection, **extra_fields):
-        if isinstance(db, pymongo.database.Database):
-            MongoConsolidate(db, collection).consolidate(self._parents)
-        elif isinstance(db, MySQLdb.connections.Connection):
-            MySQLConsolidate(db, collection, **extra_fields).consolidate(self._parents)
+def _write_int64(f, values, chunk_size=65536):
+    import struct
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        f.write(struct.pack('<%dq' % len(chunk), *chunk))
+
+
+def _write_snapshot(path, elements, journal_seq=0):
+    """ Write the 3-tuples `(object, root, weight)` to `path` in the layout read by SnapshotParents,
+    with the sequence number of the last journal record they include. The file is on disk on return.
+    """
+    import struct
+    kind = _snapshot_kind([el[0] for el in elements])
+    if kind == b'i':
+        elements.sort(key=lambda el: el[0])
+    else:
+        elements = sorted(((_encode_key(kind, el[0]),) + el for el in elements), key=lambda el: el[0])
+    position = dict((el[-3], i) for i, el in enumerate(elements))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack(_SNAPSHOT_HEADER, _SNAPSHOT_MAGIC, kind, len(elements), journal_seq))
+        _write_int64(f, [position[el[-2]] for el in elements])
+        _write_int64(f, [el[-1] for el in elements])
+        if kind == b'i':
+            _write_int64(f, [el[0] for el in elements] + [0])
         else:
-            raise TypeError('db must be an instance of pymongo.database.Database or MySQLdb.connections.Connection')
+            offsets = [0]
+            for el in elements:
+                offsets.append(offsets[-1] + len(el[0]))
+            _write_int64(f, offsets)
+            for el in elements:
+                f.write(el[0])
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)  # readers never see a partial snapshot
+    _fsync_dir(path)
+
+
+def _fsync_dir(path):
+    """ Make the rename of `path` durable, on systems where directories can be synced. """
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class InstrumentedParents(Parents):
+    """
+    Count the calls made to another Parents, i.e., the round trips of a database backend,
+    and keep a histogram of their latency.
+    Other attributes, e.g., flush() of CachedParents, are looked up in the wrapped Parents.
+    """
+    def __init__(self, parents, callback=None):
+        """
+        Parameters:
+        -----------
+        :param parents: an instance of Parents to wrap
+        :param callback: if not None, called as callback(method_name, seconds) after each call
+        """
+        self.parents = parents
+        self.callback = callback
+        self.calls = {}
+        self.latency = {}  # method name -> {upper bound in microseconds: number of calls}
+
+    def __getattr__(self, name):
+        if name == 'parents':  # not set yet, e.g., while unpickling
+            raise AttributeError(name)
+        return getattr(self.parents, name)
+
+    @property
+    def tracks_members(self):
+        return self.parents.tracks_members
+
+    @property
+    def server_side_find(self):
+        return self.parents.server_side_find
+
+    def find_path(self, obj):
+        if not self.server_side_find:
+            return Parents.find_path(self, obj)  # count each call to parent_of
+        start = timer()
+        try:
+            return self.parents.find_path(obj)
+        finally:
+            self._observe('find_path', start)
+
+    def _observe(self, name, start):
+        seconds = timer() - start
+        self.calls[name] = self.calls.get(name, 0) + 1
+        _observe_latency(self.latency.setdefault(name, {}), seconds)
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def __contains__(self, obj):
+        start = timer()
+        try:
+            return obj in self.parents
+        finally:
+            self._observe('__contains__', start)
+
+    def __getitem__(self, obj):
+        start = timer()
+        try:
+            return self.parents[obj]
+        finally:
+            self._observe('__getitem__', start)
+
+    def __setitem__(self, obj, parent):
+        start = timer()
+        try:
+            self.parents[obj] = parent
+        finally:
+            self._observe('__setitem__', start)
+
+    def inc_weight(self, obj, weight):
+        start = timer()
+        try:
+            self.parents.inc_weight(obj, weight)
+        finally:
+            self._observe('inc_weight', start)
+
+    def parent_of(self, obj):
+        start = timer()
+        try:
+            return self.parents.parent_of(obj)
+        finally:
+            self._observe('parent_of', start)
+
+    def weight_of(self, obj):
+        start = timer()
+        try:
+            return self.parents.weight_of(obj)
+        finally:
+            self._observe('weight_of', start)
+
+    def set_parents(self, mapping):
+        start = timer()
+        try:
+            self.parents.set_parents(mapping)
+        finally:
+            self._observe('set_parents', start)
+
+    def upsert_many(self, mapping):
+        start = timer()
+        try:
+            self.parents.upsert_many(mapping)
+        finally:
+            self._observe('upsert_many', start)
+
+    def parents_of(self, objects):
+        start = timer()
+        try:
+            return self.parents.parents_of(objects)
+        finally:
+            self._observe('parents_of', start)
+
+    def children_of(self, objects):
+        start = timer()
+        try:
+            return self.parents.children_of(objects)
+        finally:
+            self._observe('children_of', start)
+
+    def link_members(self, root, other):
+        self.parents.link_members(root, other)
+
+    def unlink_member(self, obj):
+        return self.parents.unlink_member(obj)
+
+    def iter_members(self, obj):
+        return self.parents.iter_members(obj)
+
+    def iter_children(self):
+        return self.parents.iter_children()
+
+    def items(self):
+        start = timer()
+        try:
+            return self.parents.items()
+        finally:
+            self._observe('items', start)
+
+
+def _observe_latency(histogram, seconds):
+    """ Count `seconds` in the histogram bucket of the next power of two microseconds. """
+    bucket = 2 ** int(seconds * 1e6).bit_length()
+    histogram[bucket] = histogram.get(bucket, 0) + 1
+
+
+class Stats(object):
+    """
+    Counters of the work done by a UnionFind, see UnionFind.enable_stats().
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.finds = 0  # finds of known objects
+        self.inserts = 0  # finds of new objects
+        self.hops = 0
+        self.max_hops = 0
+        self.compression_writes = 0
+        self.unions = 0  # unions that linked at least two roots
+        self.linked_roots = 0
+        self.union_latency = {}
+
+    def record_find(self, hops, writes):
+        self.finds += 1
+        self.hops += hops
+        self.compression_writes += writes
+        if hops > self.max_hops:
+            self.max_hops = hops
+        if self.callback is not None:
+            self.callback('find', hops)
+
+    def record_insert(self):
+        self.inserts += 1
+        if self.callback is not None:
+            self.callback('insert', 1)
+
+    def record_link(self, roots):
+        self.unions += 1
+        self.linked_roots += roots
+        if self.callback is not None:
+            self.callback('link', roots)
+
+    def record_union(self, seconds):
+        _observe_latency(self.union_latency, seconds)
+        if self.callback is not None:
+            self.callback('union', seconds)
+
+
+class Journal(object):
+    """
+    An append-only log of the operations that change a UnionFind, to replay them after a crash.
+
+    Operations are buffered and written to the file with a single fsync, once
+    `sync_bytes` bytes are pending or `sync_interval` seconds have passed since the
+    last fsync, i.e., with group commits. A background thread syncs the pending
+    operations of an idle journal, so at most the operations of the last
+    `sync_interval` seconds, or `sync_bytes` bytes, are lost on a crash.
+    Records are numbered, and snapshots keep the number of the last record they
+    include, so that replay skips the records of a journal not emptied yet.
+    Objects must be picklable. See UnionFind.attach_journal().
+    """
+    def __init__(self, path, sync_interval=1.0, sync_bytes=1 << 20):
+        """
+        Parameters:
+        -----------
+        :param path: the file of the journal, appended to if it exists
+        :param sync_interval: the maximum number of seconds between two fsyncs
+        :param sync_bytes: the maximum number of bytes written before an fsync
+        """
+        import struct
+        import threading
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self._f = open(path, 'ab')
+        self._header = struct.Struct(_JOURNAL_HEADER)
+        self.seq = 0  # the number of the last record
+        with open(path, 'rb') as f:
+            for seq, data, end in self._records(f):
+                self.seq = seq
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = timer()
+        self.records = self.syncs = 0
+        self._closed = threading.Event()
+        self._flusher = None
+        if sync_interval > 0:  # otherwise every append is synced
+            self._flusher = threading.Thread(target=self._flush_idle, name='Journal(%s)' % path)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_idle(self):
+        while not self._closed.wait(self.sync_interval):
+            with self._lock:
+                if self._pending and timer() - self._last_sync >= self.sync_interval:
+                    self._sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, method, args):
+        """ Log a call to the UnionFind method named `method` with the tuple of arguments `args`. """
+        import pickle
+        data = pickle.dumps((method, args), 2)
+        with self._lock:
+            self._write(data)
+            self.records += 1
+            if self._pending >= self.sync_bytes or timer() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _write(self, data):
+        import zlib
+        self.seq += 1
+        self._f.write(self._header.pack(len(data), zlib.crc32(data, self.seq & 0xffffffff) & 0xffffffff, self.seq))
+        self._f.write(data)
+        self._pending += self._header.size + len(data)
+
+    def _records(self, f):
+        """ Iterate over the 3-tuples (sequence number, data, end offset) of the complete and intact records. """
+        import zlib
+        while True:
+            header = f.read(self._header.size)
+            if len(header) < self._header.size:
+                return
+            size, crc, seq = self._header.unpack(header)
+            data = f.read(size)
+            if len(data) < size or zlib.crc32(data, seq & 0xffffffff) & 0xffffffff != crc:
+                return
+            yield seq, data, f.tell()
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+        self._last_sync = timer()
+        self.syncs += 1
+
+    def sync(self):
+        """ Write the buffered operations to disk. """
+        with self._lock:
+            self._sync()
+
+    def replay(self, uf, after=0):
+        """ Apply the logged operations numbered above `after` to `uf`, in order, and return their number.
+        Replay stops at the first incomplete or corrupt record, e.g., one being written
+        during a crash, and the journal is cut there so that new records follow the good ones.
+        """
+        import pickle
+        count = 0
+        good = 0
+        with self._lock:
+            self._f.flush()
+            with open(self.path, 'rb') as f:
+                for seq, data, good in self._records(f):
+                    method, args = pickle.loads(data)
+                    if seq > after and method is not None:
+                        getattr(uf, method)(*args)
+                        count += 1
+            if good < os.path.getsize(self.path):
+                self._f.truncate(good)
+        return count
+
+    def truncate(self):
+        """ Drop the logged operations, e.g., once they are saved in a snapshot or a database.
+        A marker record keeps the numbering going, across restarts too.
+        """
+        import pickle
+        with self._lock:
+            self._f.truncate(0)
+            self._write(pickle.dumps((None, ()), 2))
+            self._sync()
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self._sync()
+            self._f.close()
+
+
+def _iteritems(elements):
+    """ Iterate over the 2-tuples `(object, element)` of a dict, or of an iterable of 2-tuples, without copying. """
+    if hasattr(elements, 'iteritems'):
+        return elements.iteritems()
+    if hasattr(elements, 'items'):
+        return iter(elements.items())
+    return iter(elements)
+
+
+def _consolidate(db, collection, elements, incremental=False, **extra_fields):
+    """ Write in-memory disjoint sets to the database `db`, picking the consolidator that matches its type.
+    When `incremental` is True, the elements are upserted instead of replacing the whole collection/table.
+    """
+    interned = extra_fields.pop('interned', False)
+    if isinstance(db, MySQLPool):  # consolidate on one connection of the pool
+        pool, db = db, db.acquire()
+        try:
+            return _consolidate(db, collection, elements, incremental, interned=interned, **extra_fields)
+        finally:
+            pool.release(db)
+    if _is_mongodb(db):
+        consolidator = MongoConsolidate(db, collection, interned=interned)
+    elif _is_mysql(db):
+        consolidator = MySQLConsolidate(db, collection, interned=interned, **extra_fields)
+    elif _is_sqlite(db):
+        consolidator = SQLiteConsolidate(db, collection, interned=interned)
+    else:
+        raise TypeError('db must be an instance of pymongo.database.Database, MySQLdb.connections.Connection '
+                        'or sqlite3.Connection')
+    if incremental:
+        return consolidator.upsert(elements)
+    return consolidator.consolidate(elements)
 
 
 class Consolidate(object):
@@ -269,38 +2193,92 @@ class Consolidate(object):
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, db):
-        """ Initialize the class with an instance of db and the collection where to write to """
+    def __init__(self, db, chunk_size=10000, keys=None):
+        """ Initialize the class with an instance of db, the number of elements written at once
+        and, to store integer ids instead of the keys, an instance of Keys
+        """
         self.db = db
+        self.chunk_size = chunk_size
+        self.keys = keys
+
+    def _rows(self, chunk):
+        """ Return the 3-tuples `(object, parent, weight)` of a chunk, interning the keys if needed """
+        if self.keys is None:
+            return [(k, v['parent'], v['weight']) for k, v in chunk]
+        ids = self.keys.ids_of([k for k, v in chunk] + [v['parent'] for k, v in chunk], create=True)
+        return [(ids[k], ids[v['parent']], v['weight']) for k, v in chunk]
+
+    def _chunks(self, elements):
+        """ Split a dict, or an iterable of 2-tuples `(object, element)`, in lists of at most chunk_size items """
+        elements = _iteritems(elements)
+        while True:
+            chunk = list(islice(elements, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
 
     @abc.abstractmethod
     def consolidate(self, dict_to_consolidate):
-        """ Write the contents of the argument in a database table/collection """
+        """ Write the contents of the argument in a database table/collection and return the number of elements.
+        The argument is a dict, or an iterable of 2-tuples `(object, element)`.
+        """
+        return
+
+    @abc.abstractmethod
+    def upsert(self, dict_to_consolidate):
+        """ Insert or update the elements of the argument, keeping the other ones in the database table/collection.
+        Return the number of elements. The argument is a dict, or an iterable of 2-tuples `(object, element)`.
+        """
         return
 
 
 class MongoConsolidate(Consolidate):
-    def __init__(self, db, collection):
+    def __init__(self, db, collection, chunk_size=10000, interned=False):
         """
         Consolidate in-memory disjoint sets in a mongodb collection
 
         Parameters
         -----------
         :param db: Instance of pymongo.database.Database. Results will be stored here.
-        :param collection: String specifying the collection where to store the results. Collection is emptied if it already exists.
+        :param collection: String specifying the collection where to store the results. Collection is replaced if it already exists.
+        :param chunk_size: Number of elements inserted at once.
+        :param interned: If True, store integer ids, mapped to the keys in the collection `<collection>_keys`.
         """
-        if not isinstance(db, pymongo.database.Database):
+        if not _is_mongodb(db):
             raise TypeError('db must be a valid instance of pymongo.database.Database')
         self.collection = collection
-        super(MongoConsolidate, self).__init__(db)
+        super(MongoConsolidate, self).__init__(db, chunk_size, MongoKeys(db, collection) if interned else None)
 
     def consolidate(self, dict_to_consolidate):
-        self.db.drop_collection(self.collection)
-        return self.db[self.collection].insert([dict(v, **{"_id": k}) for k, v in dict_to_consolidate.items()])
+        # write to a staging collection, then swap it with the live one so that readers never see it half-written
+        staging = self.collection + '_staging'
+        self.db.drop_collection(staging)
+        count = 0
+        for chunk in self._chunks(dict_to_consolidate):
+            self.db[staging].insert_many([{'_id': k, 'parent': p, 'weight': w} for k, p, w in self._rows(chunk)],
+                                         ordered=False)
+            count += len(chunk)
+        if count:
+            self.db[staging].create_index('parent')
+            self.db[staging].rename(self.collection, dropTarget=True)
+        else:
+            self.db.drop_collection(self.collection)
+        return count
+
+    def upsert(self, dict_to_consolidate):
+        import pymongo
+        count = 0
+        for chunk in self._chunks(dict_to_consolidate):
+            requests = [pymongo.ReplaceOne({'_id': k}, {'_id': k, 'parent': p, 'weight': w}, upsert=True)
+                        for k, p, w in self._rows(chunk)]
+            self.db[self.collection].bulk_write(requests, ordered=False)
+            count += len(chunk)
+        self.db[self.collection].create_index('parent')
+        return count
 
 
 class MySQLConsolidate(Consolidate):
-    def __init__(self, db, table, **extra_fields):
+    def __init__(self, db, table, chunk_size=10000, interned=False, **extra_fields):
         """
         Consolidate disjoint sets to a mysql database.
 
@@ -308,14 +2286,16 @@ class MySQLConsolidate(Consolidate):
         -----------
         :param db: Instance of MySQLdb.connections.Connection
         :param table: String specifying the table where to store the results.
+        :param chunk_size: Number of rows inserted at once.
+        :param interned: If True, store BIGINT ids, mapped to the keys in the table `<table>_keys`.
         :param **extra_fields: Extra fields that are added to each row. E.g., 'role_type'='inventor'
         """
-        if not isinstance(db, MySQLdb.connections.Connection):
+        if not _is_mysql(db):
             raise TypeError('db must be a valid instance of MySQLdb.connections.Connection')
-        self.cur = db.cursor(MySQLdb.cursors.DictCursor)
+        self.cur = db.cursor(_import_mysqldb().cursors.DictCursor)
         self.table = table
         self.extra_fields = extra_fields
-        super(MySQLConsolidate, self).__init__(db)
+        super(MySQLConsolidate, self).__init__(db, chunk_size, MySQLKeys(db, table) if interned else None)
 
     def _create_table_query(self):
         """
@@ -325,44 +2305,226 @@ class MySQLConsolidate(Consolidate):
         # we create one VARCHAR(16) for each extra field specified
         fields = ' %s VARCHAR(16), ' * len(extra_fields)
         fields = fields % extra_fields
-        fields += '_id VARCHAR(100), parent VARCHAR(100), weight INT'
+        if self.keys is not None:  # integer ids take 8 bytes in the data and in the primary key
+            fields += '_id BIGINT, parent BIGINT, weight INT'
+        else:
+            fields += '_id VARCHAR(100), parent VARCHAR(100), weight INT'
         # primary key is composed of all extra fields plus _id
         # create the primary key sql code
         prikey = ' %s, ' * len(extra_fields)
         prikey = prikey % extra_fields
         prikey += '_id'
+        parent_key = ''.join(' %s, ' % f_name for f_name in extra_fields) + 'parent'  # to find the children
         query = 'CREATE TABLE IF NOT EXISTS %s ' % self.table
-        query += '(%s, PRIMARY KEY (%s)) ' % (fields, prikey)
+        query += '(%s, PRIMARY KEY (%s), KEY (%s)) ' % (fields, prikey, parent_key)
         query += 'DEFAULT CHARACTER SET utf8 COLLATE utf8_bin'  # necessary to allow unicode comparisons
         return query
 
-    def _clear_old_query(self):
+    def _copy_others_query(self, staging):
         """
-        Clear previously existing entries for a given combination of _id and extra_fields.
+        Copy the rows of the other combinations of extra_fields to the staging table.
         """
-        query = 'DELETE FROM %s WHERE ' % self.table
-        for f_name, f_val in self.extra_fields.iteritems():  # possibly delete only matching fields
-            query += '%s = \'%s\' AND ' % (f_name, f_val)
-        query += '_id IS NOT NULL'
+        query = 'INSERT INTO %s SELECT * FROM %s WHERE NOT (' % (staging, self.table)
+        query += ' AND '.join('%s = \'%s\'' % (f_name, f_val) for f_name, f_val in self.extra_fields.items())
+        query += ')'
+        return query
+
+    def _insert_query(self, table):
+        """
+        Inserts one row, with the extra fields, into `table`.
+        """
+        query = "INSERT INTO `%s` " % table
+        query += 'SET '
+        for f_name, f_val in self.extra_fields.items():
+            query += " %s = '%s', " % (f_name, f_val)
+        query += "_id = %s, parent = %s, weight = %s"  # _id, parent and weight
         return query
 
     def consolidate(self, dict_to_consolidate):
-        values = []
-        # unfold the dictionary
-        for k, v in dict_to_consolidate.items():  # this will speed-up database insertions
-            values.append((k, v['parent'], v['weight']))
+        # write to a staging table, then swap it with the live one so that readers never see it half-written
+        staging = self.table + '_staging'
+        old = self.table + '_old'
+        with self.db:
+            self.cur.execute(self._create_table_query())
+            self.cur.execute('DROP TABLE IF EXISTS %s' % staging)
+            self.cur.execute('CREATE TABLE %s LIKE %s' % (staging, self.table))
+            if self.extra_fields:  # rows with other extra fields are kept
+                self.cur.execute(self._copy_others_query(staging))
+
+        count = 0
+        query = self._insert_query(staging)
+        for chunk in self._chunks(dict_to_consolidate):
+            with self.db:
+                self.cur.executemany(query, self._rows(chunk))
+            count += len(chunk)
 
+        with self.db:
+            self.cur.execute('DROP TABLE IF EXISTS %s' % old)
+            self.cur.execute('RENAME TABLE %s TO %s, %s TO %s' % (self.table, old, staging, self.table))
+            self.cur.execute('DROP TABLE %s' % old)
+        return count
+
+    def upsert(self, dict_to_consolidate):
         with self.db:
             self.cur.execute(self._create_table_query())
-            self.cur.execute(self._clear_old_query())
-            query = "INSERT INTO `%s` " % self.table
-            query += 'SET '
-            for f_name, f_val in self.extra_fields.iteritems():
-                query += " %s = '%s', " % (f_name, f_val)
-            query += "_id = %s, parent = %s, weight = %s"  # _id, parent and weight
-            self.cur.executemany(query, values)
+        count = 0
+        query = self._insert_query(self.table)
+        query += " ON DUPLICATE KEY UPDATE parent = VALUES(parent), weight = VALUES(weight)"
+        for chunk in self._chunks(dict_to_consolidate):
+            with self.db:
+                self.cur.executemany(query, self._rows(chunk))
+            count += len(chunk)
+        return count
+
+
+def _iter_edges(src, dst=None):
+    """ Iterate over the edges given as two parallel sequences, or as a single iterable of 2-tuples. """
+    if dst is None:
+        return iter(src)
+    if hasattr(src, 'tolist'):  # NumPy arrays, avoid per-element scalar boxing
+        src, dst = src.tolist(), dst.tolist()
+    return izip(src, dst)
+
+
+def _local_forest(edges):
+    """ Union the edges in a new in-memory structure and return the (element, root) pairs of the elements
+    that are not roots, and a (root, root) pair for each isolated element. Run by worker processes.
+    """
+    uf = UnionFind()
+    uf.union_edges(edges)
+    items = list(uf.parents.items())
+    roots = uf.find_many([obj for obj, el in items])
+    return [(obj, root) for (obj, el), root in izip(items, roots) if obj != root or el['weight'] == 1]
+
+
+class SQLiteConsolidate(Consolidate):
+    def __init__(self, db, table, chunk_size=10000, interned=False):
+        """
+        Consolidate disjoint sets to a sqlite database.
+
+        Parameters
+        -----------
+        :param db: Instance of sqlite3.Connection
+        :param table: String specifying the table where to store the results. Table is replaced if it already exists.
+        :param chunk_size: Number of rows inserted at once.
+        :param interned: If True, store integer ids, mapped to the keys in the table `<table>_keys`.
+        """
+        if not _is_sqlite(db):
+            raise TypeError('db must be a valid instance of sqlite3.Connection')
+        self.table = table
+        super(SQLiteConsolidate, self).__init__(db, chunk_size, SQLiteKeys(db, table) if interned else None)
 
-        return dict_to_consolidate.keys()
+    def _insert(self, table, dict_to_consolidate, verb='INSERT'):
+        count = 0
+        query = '%s INTO %s (_id, parent, weight) VALUES (?, ?, ?)' % (verb, table)
+        for chunk in self._chunks(dict_to_consolidate):
+            self.db.executemany(query, self._rows(chunk))
+            count += len(chunk)
+        return count
+
+    def consolidate(self, dict_to_consolidate):
+        # write to a staging table, then swap it with the live one in a single transaction
+        staging = self.table + '_staging'
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS %s' % staging)
+            self.db.execute(_sqlite_create_table_query(staging))
+        count = self._insert(staging, dict_to_consolidate)
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS %s' % self.table)
+            self.db.execute('ALTER TABLE %s RENAME TO %s' % (staging, self.table))
+            self.db.execute(_sqlite_create_index_query(self.table))
+        return count
+
+    def upsert(self, dict_to_consolidate):
+        with self.db:
+            self.db.execute(_sqlite_create_table_query(self.table))
+            self.db.execute(_sqlite_create_index_query(self.table))
+            return self._insert(self.table, dict_to_consolidate, 'INSERT OR REPLACE')
+
+
+_storage = {}  # name -> factory of Parents
+
+
+def register_storage(name, factory):
+    """ Make UnionFind(db, collection, storage=name, **options) use the engine built by `factory`.
+
+    The factory is called as factory(db, collection, **options) and returns an instance
+    of Parents. Drivers should only be imported when it is called. Other packages can
+    register a factory as an entry point named `name` in the group 'unionfind.storage',
+    which is loaded the first time the storage is asked for.
+    """
+    _storage[name] = factory
+    if name not in available_storage:
+        available_storage.append(name)
+
+
+def _storage_factory(name):
+    """ Return the factory registered for the storage `name`, looking for an entry point if needed, or None. """
+    if name not in _storage:
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:  # python < 3.8
+            return None
+        eps = entry_points()
+        eps = eps.select(group='unionfind.storage') if hasattr(eps, 'select') else eps.get('unionfind.storage', ())
+        for ep in eps:
+            if ep.name == name:
+                register_storage(name, ep.load())
+                break
+    return _storage.get(name)
+
+
+def _interned(parents, db, collection, interned):
+    return InternedParents(parents, _keys_for(db, collection)) if interned else parents
+
+
+def _mongodb_storage(db, collection, server_side_find=False, interned=False, **extra_fields):
+    # extra fields are only supported by mysql, and ignored here
+    return _interned(MongoParents(db, collection, server_side_find), db, collection, interned)
+
+
+def _mysql_storage(db, collection, server_side_find=False, interned=False, **extra_fields):
+    return _interned(MySQLParents(db, collection, server_side_find, **extra_fields), db, collection, interned)
+
+
+def _sqlite_storage(db, collection, server_side_find=False, interned=False, commit_every=1000, **extra_fields):
+    parents = SQLiteParents(db, collection, commit_every=commit_every, server_side_find=server_side_find)
+    return _interned(parents, db, collection, interned)
+
+
+register_storage('mongodb', _mongodb_storage)
+register_storage('mysql', _mysql_storage)
+register_storage('sqlite', _sqlite_storage)
+register_storage('array', lambda db, collection, **options: ArrayParents(interned=True))
+register_storage('dict', lambda db, collection, **options: DictParents())
+
+
+def _roots_of(parent):
+    """ Return a dict mapping each object of the dict `parent`, object -> its parent, to its root,
+    and a dict mapping it to its depth. Every parent must be in `parent`.
+    """
+    roots, depth = {}, {}
+    for obj in parent:
+        if obj in roots:
+            continue
+        up = parent[obj]
+        if up == obj:
+            roots[obj], depth[obj] = obj, 0
+            continue
+        if parent[up] == up:  # the common case of a compressed path
+            roots[obj], depth[obj] = up, 1
+            continue
+        path = []
+        while obj not in roots:
+            if parent[obj] == obj:
+                roots[obj], depth[obj] = obj, 0
+                break
+            path.append(obj)
+            obj = parent[obj]
+        for x in reversed(path):
+            roots[x], depth[x] = roots[obj], depth[obj] + 1
+            obj = x
+    return roots, depth
 
 
 class UnionFind:
@@ -382,65 +2544,559 @@ class UnionFind:
       in X, it is added to X as one of the members of the merged set.
 
     """
-    def __init__(self, db=None, collection=None, storage='mongodb', **extra_fields):
+    def __init__(self, db=None, collection=None, storage='mongodb', parents=None, **extra_fields):
         """Create a new empty union-find structure.
 
         Parameters
-        :param **extra_fields: if storage='mysql', these extra fields are added to each item in the database
+        :param storage: a name in available_storage: 'mongodb', 'mysql', 'sqlite', 'array' for the in-memory
+            ArrayParents engine, 'dict', or any name added with register_storage()
+        :param parents: an instance of Parents to use as the engine, overriding the other parameters
+        :param **extra_fields: if storage='mysql', these extra fields are added to each item in the database.
+            server_side_find=True makes database engines resolve roots with a single query,
+            interned=True makes them store integer ids, mapped to the keys in `<collection>_keys`
         """
-        if db is None or collection is None or storage not in available_storage:
-            self.parents = DictParents()
-        elif storage == 'mongodb':
-            self.parents = MongoParents(db, collection)
-        else:  # storage == 'mysql':
-            self.parents = MySQLParents(db, collection, **extra_fields)
-
+        if parents is not None:
+            self.parents = parents
+        else:
+            factory = _storage_factory(storage)
+            if factory is None or storage in ('mongodb', 'mysql', 'sqlite') and (db is None or collection is None):
+                factory = _storage['dict']
+            self.parents = factory(db, collection, **extra_fields)
+        self._stats = None
+        self._num_sets = None  # counted on first use, then kept up to date
+        self._largest = None  # heap of (-weight, tie breaker, root), possibly stale, built on first use
+        self._tie_breaker = count()
+        self._undo = None  # log of the changes since the outermost open checkpoint
+        self._checkpoints = []  # offset in the log of each open checkpoint, outermost first
+        self._compress = True
+        self._journal = None
+        self._journal_seq = 0  # the last journal record included in the snapshot loaded
 
     def __getitem__(self, obj):
         """Find and return the name of the set containing the object."""
 
-        # check for previously unknown object
-        if obj not in self.parents:
-            self.parents[obj] = obj
-            return obj
-
+        # check for previously unknown object. Engines that resolve paths
+        # on the server raise KeyError instead, saving a round trip
+        if self.parents.server_side_find:
+            try:
+                return self._find(obj)
+            except KeyError:
+                pass
+        elif obj in self.parents:
+            return self._find(obj)
+        self._insert(obj)
+        return obj
+
+    def _insert(self, obj):
+        """Add the unknown object as a singleton and return True."""
+        self.parents[obj] = obj
+        if self._stats is not None:
+            self._stats.record_insert()
+        if self._num_sets is not None:  # the heap of the largest sets is only built once they are counted
+            self._sets_changed(1, [(obj, 1)])
+        return True
+
+    def _insert_many(self, objects):
+        """Add the unknown objects as singletons and return the set of them."""
+        parents = self.parents
+        for obj in objects:
+            parents[obj] = obj
+        if self._stats is not None:
+            for obj in objects:
+                self._stats.record_insert()
+        if self._num_sets is not None:
+            self._sets_changed(len(objects), [(obj, 1) for obj in objects])
+        return set(objects)
+
+    def _find(self, obj):
+        """Return the root of the object, which must be known, compressing its path."""
         # find path of objects leading to the root
-        path = [obj]
-        root = self.parents[obj]['parent']
-        while root != path[-1]:
-            path.append(root)
-            root = self.parents[root]['parent']
-
-        # compress the path and return
-        for ancestor in path:
-            self.parents[ancestor] = root
+        path = self.parents.find_path(obj)
+        root = path[-1]
+
+        # compress the path and return. The last two objects are
+        # the root and its child, which already point to the root
+        if len(path) > 2 and self._compress:
+            if self._undo is not None:
+                self._undo.append(('parents', dict(zip(path[:-2], path[1:-1]))))
+            self.parents.set_parents(dict.fromkeys(path[:-2], root))
+        if self._stats is not None:
+            self._stats.record_find(len(path) - 1, max(len(path) - 2, 0) if self._compress else 0)
         return root
 
+    def find_many(self, objects):
+        """Return the list of the names of the sets containing each object, adding unknown objects.
+
+        All the objects go up their paths together, one level per round, and the
+        parents of each level are fetched with a single call to the engine, i.e.,
+        one query on a database. Then, every path is compressed with a single
+        call. For k objects at depth up to d, that is O(d) round trips instead
+        of O(k*d).
+        """
+        objects = list(objects)
+        roots = self._find_roots(list(OrderedDict.fromkeys(objects)))[0]
+        return [roots[obj] for obj in objects]
+
+    def _find_roots(self, distinct):
+        """Resolve the roots of the `distinct` objects as find_many(). Return a dict from each of them
+        (and possibly more) to its root, and the set of the objects added as singletons.
+        """
+        parent = self.parents.parents_of(distinct)  # every known object seen so far -> its parent
+        # only the objects themselves may be unknown. Those added here are roots of their own
+        new = self._insert_many([obj for obj in distinct if obj not in parent])
+        # objects added by another thread in the meantime, then the parents not seen yet
+        pending = [obj for obj in distinct if obj not in parent and obj not in new]
+        pending.extend(p for p in set(parent.values()) if p not in parent)
+        while pending:
+            fetched = self.parents.parents_of(pending)
+            parent.update(fetched)
+            pending = [p for p in set(fetched.values()) if p not in parent]
+
+        # resolve the root and depth of everything seen, following the parents in memory
+        roots, depth = _roots_of(parent)
+        roots.update(izip(new, new))
+
+        if self._compress:
+            moved = dict((x, roots[x]) for x in depth if depth[x] > 1)
+            if self._undo is not None and moved:
+                self._undo.append(('parents', dict((x, parent[x]) for x in moved)))
+            self.parents.set_parents(moved)
+        if self._stats is not None:
+            for obj in distinct:
+                if obj not in new:
+                    self._stats.record_find(depth[obj], max(depth[obj] - 1, 0) if self._compress else 0)
+        return roots, new
+
+    def _link(self, roots):
+        """Attach each of the distinct `roots` under the heaviest one and return it."""
+        parents = self.parents
+        if len(roots) == 2:  # the common case: two lookups, no sorting and a single write of each kind
+            a, b = roots
+            wa, wb = parents.weight_of(a), parents.weight_of(b)
+            if wa < wb or wa == wb and a < b:
+                a, b, wa, wb = b, a, wb, wa
+            if self._undo is not None:
+                self._undo.append(('link', a, {a: wa, b: wb}))
+            parents.inc_weight(a, wb)
+            parents.set_parents({b: a})
+            parents.link_members(a, b)
+            if self._stats is not None:
+                self._stats.record_link(2)
+            if self._num_sets is not None:
+                self._sets_changed(-1, [(a, wa + wb)])
+            return a
+        weights = dict((r, parents.weight_of(r)) for r in roots)
+        heaviest = max([(w, r) for r, w in weights.items()])[1]
+        others = [r for r in weights if r != heaviest]
+        grown = sum(weights[r] for r in others)
+        if self._undo is not None:
+            self._undo.append(('link', heaviest, weights))
+        parents.inc_weight(heaviest, grown)
+        parents.set_parents(dict.fromkeys(others, heaviest))
+        for r in others:
+            parents.link_members(heaviest, r)
+        if self._stats is not None:
+            self._stats.record_link(len(roots))
+        if self._num_sets is not None:
+            self._sets_changed(-len(others), [(heaviest, weights[heaviest] + grown)])
+        return heaviest
+
+    def _sets_changed(self, delta, weights):
+        """Keep the number of sets and the heap of the largest sets up to date, once they are in use.
+
+        `delta` is the change in the number of sets, `weights` the 2-tuples (root, weight)
+        of the sets that were created or grew. Older heap entries are left behind, stale.
+        """
+        if self._num_sets is not None:
+            self._num_sets += delta
+        if self._largest is not None:
+            import heapq
+            for root, weight in weights:
+                heapq.heappush(self._largest, (-weight, next(self._tie_breaker), root))
+
     def union(self, *objects):
         """Find the sets containing the objects and merge them all."""
-        roots = [self[x] for x in objects]
-        heaviest = max([(self.parents[r]['weight'], r) for r in roots])[1]
-        for r in roots:
-            if r != heaviest:
-                self.parents.inc_weight(heaviest, self.parents[r]['weight'])
-                self.parents[r] = heaviest
+        if self._stats is not None:
+            start = timer()
+        if len(objects) == 2:  # the common case, without building a set
+            a, b = self[objects[0]], self[objects[1]]
+            if a != b:
+                self._link((a, b))
+        else:
+            roots = set([self[x] for x in objects])
+            if len(roots) > 1:
+                self._link(roots)
+        if self._stats is not None:
+            self._stats.record_union(timer() - start)
+        if self._journal is not None:
+            self._journal.append('union', objects)
+
+    def union_edges(self, src, dst=None, batch_size=65536):
+        """Merge the sets at the two ends of each edge.
+
+        Edges are either given as two parallel sequences `src` and `dst`
+        (e.g., NumPy arrays), or as a single iterable of 2-tuples in `src`.
+        Edges are processed in batches: the roots of the distinct endpoints
+        are resolved once per batch with find_many(), then merged by weight in
+        a local in-memory forest, and the links and weights of the merged roots
+        are written back once per batch. The resulting roots and weights are
+        the same as calling union() on every edge in order.
+        """
+        edges = _iter_edges(src, dst)
+        while True:
+            batch = list(islice(edges, batch_size))
+            if not batch:
+                return
+            roots, new = self._find_roots(list(dict.fromkeys(chain.from_iterable(batch))))
+            weight_of = self.parents.weight_of
+            weights = dict.fromkeys(new, 1)  # root -> its weight before the batch
+            current = dict(weights)  # root -> its weight in the local forest
+            merged = {}  # root merged during this batch -> root it was attached to
+            for a, b in batch:
+                ra = roots[a]
+                while ra in merged:
+                    ra = merged[ra]
+                rb = roots[b]
+                while rb in merged:
+                    rb = merged[rb]
+                if ra == rb:
+                    continue
+                wa = current.get(ra)
+                if wa is None:
+                    wa = weights[ra] = weight_of(ra)
+                wb = current.get(rb)
+                if wb is None:
+                    wb = weights[rb] = weight_of(rb)
+                if wa < wb or (wa == wb and ra < rb):  # the same choice as max() in _link()
+                    ra, rb = rb, ra
+                merged[rb] = ra
+                current[ra] = wa + wb
+                # keep the forwarding chains short
+                roots[a] = roots[b] = ra
+            if merged:
+                self._link_forest(merged, weights, current)
+            if self._journal is not None:
+                self._journal.append('union_edges', (batch,))
+
+    def _link_forest(self, merged, weights, current):
+        """Write back the roots merged in a local forest, given as root -> root it was attached to,
+        with one call to set_parents(). `weights` and `current` hold the weight of each root
+        before and after the merges.
+        """
+        link_members = self.parents.link_members
+        moved = {}  # merged root -> final root
+        for r in merged:
+            heaviest = merged[r]
+            while heaviest in merged:
+                heaviest = merged[heaviest]
+            moved[r] = heaviest
+            link_members(heaviest, r)
+        finals = set(moved.values())
+        if self._undo is not None or self._stats is not None:
+            groups = dict((heaviest, {heaviest: weights[heaviest]}) for heaviest in finals)
+            for r in moved:
+                groups[moved[r]][r] = weights[r]
+            for heaviest, linked in groups.items():
+                if self._undo is not None:
+                    self._undo.append(('link', heaviest, linked))
+                if self._stats is not None:
+                    self._stats.record_link(len(linked))
+        for heaviest in finals:
+            self.parents.inc_weight(heaviest, current[heaviest] - weights[heaviest])
+        self.parents.set_parents(moved)
+        if self._num_sets is not None:
+            self._sets_changed(-len(moved), [(heaviest, current[heaviest]) for heaviest in finals])
+
+    def union_edges_parallel(self, src, dst=None, workers=None, chunk_size=100000):
+        """Merge the sets at the two ends of each edge, using a pool of processes.
+
+        Edges are given as in union_edges() and split in chunks of `chunk_size` edges.
+        Each of the `workers` processes (by default, one per CPU) builds a local
+        union-find structure for a chunk and sends back the links of its forest,
+        which are then merged here in batches, as in union_edges(). The resulting
+        sets and their weights are the same as in the serial union_edges(), though
+        sets may be named by different members. Objects must be picklable.
+        """
+        import multiprocessing
+        workers = workers or multiprocessing.cpu_count()
+        edges = _iter_edges(src, dst)
+        chunks = iter(lambda: list(islice(edges, chunk_size)), [])
+        pool = multiprocessing.Pool(workers)
+        try:
+            # keep a bounded number of chunks in flight, so that edges are read as they are consumed
+            in_flight = deque()
+            for chunk in chunks:
+                in_flight.append(pool.apply_async(_local_forest, (chunk,)))
+                if len(in_flight) >= 2 * workers:
+                    self.union_edges(in_flight.popleft().get())
+            while in_flight:
+                self.union_edges(in_flight.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def enable_stats(self, callback=None):
+        """Start counting finds, path lengths, compression writes, unions and calls to the engine.
+
+        When `callback` is not None, it is called as callback(event, value) on each
+        find ('find', hops), new object ('insert', 1), link ('link', number of roots),
+        union ('union', seconds) and call to the engine (method name, seconds).
+        Counters are approximate when several threads share the structure.
+        """
+        self.disable_stats()
+        self.parents = InstrumentedParents(self.parents, callback)
+        self._stats = Stats(callback)
+
+    def disable_stats(self):
+        """Stop counting, removing any overhead from the finds and unions."""
+        if isinstance(self.parents, InstrumentedParents):
+            self.parents = self.parents.parents
+        self._stats = None
+
+    def stats(self):
+        """Return a dict with the counters collected since enable_stats(), or None if disabled."""
+        stats = self._stats
+        if stats is None:
+            return None
+        return {
+            'finds': stats.finds,
+            'inserts': stats.inserts,
+            'hops': stats.hops,
+            'max_hops': stats.max_hops,
+            'mean_hops': float(stats.hops) / stats.finds if stats.finds else 0.0,
+            'compression_writes': stats.compression_writes,
+            'unions': stats.unions,
+            'linked_roots': stats.linked_roots,
+            'inc_weight': self.parents.calls.get('inc_weight', 0),
+            'union_latency_us': dict(stats.union_latency),
+            'backend_calls': dict(self.parents.calls),
+            'backend_latency_us': dict((k, dict(v)) for k, v in self.parents.latency.items()),
+        }
 
     def deunion(self, *objects):
         """Remove each object from the set it currently belongs to and put it into a singleton"""
-        # to avoid breaking currently existing paths, we must be sure all paths are compressed
-        # indeed, self.items() actually compress paths before returning items
-        items = [item for item in self.items()]
+        self.deunion_many(objects)
+
+    def deunion_many(self, objects):
+        """Remove each object of the iterable from the set it currently belongs to and put it into a singleton.
+
+        Only the sets containing the objects are touched. When the engine does not track
+        members, they are fetched once for the whole batch, with one call per tree level.
+        """
+        objects = list(objects)
+        index = None
+        if not self.parents.tracks_members:
+            index, parent = self._members_of(self.find_many(objects))  # also adds unknown objects
         for obj in objects:
-            # pick only the guys that have obj as their parent, i.e.:
-            # -- all the guys in set containing obj, or,
-            # -- none if obj have been elected as the parent of the set that contains it
-            cur_set = [item[0] for item in items if item[1] == obj and item[0] != obj]
-            for el in cur_set:
-                self.parents[el] = cur_set[0]  # el[0] arbitrarily becomes the new set representative, i.e. the parent
-            self.parents[obj] = obj  # and obj ends up in a singleton containing itself, only.
+            if index is None and obj not in self.parents:
+                self[obj]  # a new singleton
+                continue
+            root = self[obj]
+            if index is None:
+                members = list(self.parents.iter_members(root))
+            else:
+                members = index.pop(root, [root])
+            if len(members) == 1:
+                continue
+            rest = [m for m in members if m != obj]
+            if obj == root:
+                # rest[0] arbitrarily becomes the new set representative, i.e. the parent
+                new_root = rest[0]
+                moved = dict.fromkeys(rest, new_root)
+                deltas = [(new_root, len(rest) - self.parents.weight_of(new_root))]
+            else:
+                new_root = root
+                # paths may go through obj, make them skip it
+                if index is None:
+                    moved = dict((m, root) for m in rest if m != root and self.parents.parent_of(m) == obj)
+                else:
+                    moved = dict((m, root) for m in rest if parent[m] == obj)
+                deltas = [(root, -1)]
+            # and obj ends up in a singleton containing itself, only.
+            weight = self.parents.weight_of(obj)
+            if weight != 1:
+                deltas.append((obj, 1 - weight))
+            if self._undo is not None:
+                previous = dict((m, self.parents.parent_of(m)) for m in moved)
+                previous[obj] = self.parents.parent_of(obj)
+            for x, delta in deltas:
+                self.parents.inc_weight(x, delta)
+            self.parents.set_parents(moved)
+            if index is not None:
+                index[new_root] = rest
+                parent.update(moved)
+                parent[obj] = obj
+            before = self.parents.unlink_member(obj)
+            self.parents[obj] = obj
+            if self._undo is not None:
+                self._undo.append(('deunion', obj, root, before, previous, deltas, len(members)))
+            self._sets_changed(1, [(new_root, len(rest)), (obj, 1)])
+        if self._journal is not None:
+            self._journal.append('deunion_many', (objects,))
+
+    def _members_of(self, roots):
+        """Return a dict mapping each of the `roots` to the list of the members of its set, and
+        a dict mapping each member to its parent. Trees are walked down from the roots, with one
+        call to children_of() per level.
+        """
+        members = dict((root, [root]) for root in roots)
+        parent = dict((root, root) for root in members)
+        owner = dict(parent)  # member -> root
+        level = list(members)
+        while level:
+            children = self.parents.children_of(level)
+            level = []
+            for p, c in children.items():
+                for obj in c:
+                    parent[obj] = p
+                    owner[obj] = owner[p]
+                    members[owner[p]].append(obj)
+                    level.append(obj)
+        return members, parent
+
+    def checkpoint(self, compress=False):
+        """Start logging changes, and return a token to roll them back with rollback(token).
+
+        Checkpoints nest. While one is open, unions and deunions record the parents and
+        weights they change, so that rolling back costs as much as the changes made since
+        the checkpoint. Unless `compress` is True, paths are not compressed, relying on
+        union by weight alone to keep them short, and nothing is logged by finds.
+        Objects added since the checkpoint stay, as singletons, after a rollback.
+        """
+        if self._undo is None:
+            self._undo = []
+            self._compress = compress
+        self._checkpoints.append(len(self._undo))
+        if self._journal is not None:
+            self._journal.append('checkpoint', (compress,))
+        return len(self._checkpoints) - 1  # the depth of the checkpoint
+
+    def _check_token(self, token):
+        if not 0 <= token < len(self._checkpoints):
+            raise ValueError('no open checkpoint matches %r' % (token,))
+
+    def rollback(self, token):
+        """Undo the unions and deunions made since checkpoint() returned `token`, and close that checkpoint."""
+        self._check_token(token)
+        undo = self._undo
+        offset = self._checkpoints[token]
+        while len(undo) > offset:
+            entry = undo.pop()
+            if entry[0] == 'parents':
+                self.parents.set_parents(entry[1])
+            elif entry[0] == 'link':
+                heaviest, weights = entry[1], entry[2]
+                others = [r for r in weights if r != heaviest]
+                for r in reversed(others):
+                    # splicing the member lists again splits them back
+                    self.parents.link_members(heaviest, r)
+                self.parents.set_parents(dict((r, r) for r in others))
+                self.parents.inc_weight(heaviest, -sum(weights[r] for r in others))
+                self._sets_changed(len(others), weights.items())
+            else:  # 'deunion'
+                obj, root, before, previous, deltas, size = entry[1:]
+                for x, delta in deltas:
+                    self.parents.inc_weight(x, -delta)
+                self.parents.set_parents(previous)
+                if before is not None:
+                    self.parents.link_members(before, obj)
+                self._sets_changed(-1, [(root, size)])
+        self._close(token)
+        if self._journal is not None:
+            self._journal.append('rollback', (token,))
+
+    def commit(self, token):
+        """Keep the changes made since checkpoint() returned `token`, and close that checkpoint."""
+        self._check_token(token)
+        self._close(token)
+        if self._journal is not None:
+            self._journal.append('commit', (token,))
+
+    def _check_no_checkpoint(self, operation):
+        # a snapshot would hold changes that may still be rolled back, after the journal that undoes them is emptied
+        if self._checkpoints:
+            raise ValueError('cannot %s while a checkpoint is open, commit or roll it back first' % operation)
+
+    def _close(self, token):
+        # checkpoints opened after the one being closed are closed too
+        del self._checkpoints[token:]
+        if not self._checkpoints:
+            self._undo = None
+            self._compress = True
+
+    @property
+    def num_sets(self):
+        """The number of disjoint sets. The first call scans the engine, then it is kept up to date."""
+        if self._num_sets is None:
+            self._count_sets()
+        return self._num_sets
+
+    def _count_sets(self):
+        if self._num_sets is None:
+            self._num_sets = sum(1 for obj, el in self.parents.items() if el['parent'] == obj)
+
+    def size(self, obj):
+        """Return the number of objects in the set containing the object, i.e., the weight of its root."""
+        return self.parents.weight_of(self[obj])
+
+    def largest(self, k):
+        """Return the list of the 2-tuples (root, size) of the `k` largest sets, largest first.
+
+        A heap of the sets is built on first use, with a scan of the engine. Then, linked
+        and split sets are pushed as they change, and the entries of sets that changed
+        again or stopped being roots are dropped when they reach the top of the heap.
+        """
+        import heapq
+        self._count_sets()
+        if self._largest is None or len(self._largest) > 2 * self._num_sets + 64:
+            # too many stale entries, start over
+            self._largest = [(-el['weight'], next(self._tie_breaker), obj)
+                             for obj, el in self.parents.items() if el['parent'] == obj]
+            heapq.heapify(self._largest)
+        res = []
+        top = []
+        seen = set()
+        while self._largest and len(res) < k:
+            entry = heapq.heappop(self._largest)
+            weight, root = -entry[0], entry[2]
+            if root in seen or self.parents.parent_of(root) != root or self.parents.weight_of(root) != weight:
+                continue
+            seen.add(root)
+            top.append(entry)
+            res.append((root, weight))
+        for entry in top:  # still valid
+            heapq.heappush(self._largest, entry)
+        return res
+
+    def consolidate(self, db, collection, incremental=False, **extra_fields):
+        """Write the disjoint sets to a database. When `incremental` is True, only the elements changed
+        since the last consolidation are written, if the engine keeps track of them.
+        Raise ValueError if a checkpoint is open.
+        """
+        self._check_no_checkpoint('consolidate')
+        count = self.parents.consolidate(db, collection, incremental, **extra_fields)
+        if self._journal is not None:
+            self._journal.truncate()
+        return count
+
+    def attach_journal(self, journal, replay=True):
+        """Log the unions, deunions and checkpoints to a Journal from now on.
+
+        When `replay` is True, the operations already in the journal are applied
+        first, e.g., on top of the snapshot or the database they were logged after.
+        Those already in the snapshot loaded are skipped. The journal is emptied by
+        save() and consolidate(), once the snapshot is on disk. Return the number of
+        replayed operations.
+        """
+        self._journal = None
+        count = journal.replay(self, self._journal_seq) if replay else 0
+        self._journal = journal
+        return count
 
-    def consolidate(self, db, collection, **extra_fields):
-        return self.parents.consolidate(db, collection, **extra_fields)
+    def detach_journal(self):
+        """Stop logging, and return the journal."""
+        journal, self._journal = self._journal, None
+        return journal
 
     def items(self):
         """
@@ -449,9 +3105,229 @@ class UnionFind:
         for item in self.parents.items():
             yield (item[0], self[item[0]])
 
+    def save(self, path):
+        """
+        Write the disjoint sets to a compact binary file, with every path compressed.
+        Raise ValueError if a checkpoint is open.
+        """
+        self._check_no_checkpoint('save')
+        elements = [(item[0], item[1], self.parents.weight_of(item[0])) for item in self.items()]
+        _write_snapshot(path, elements, self._journal.seq if self._journal is not None else self._journal_seq)
+        if self._journal is not None:
+            self._journal.truncate()
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Return a union-find structure with the disjoint sets written by save().
+
+        When `mmap` is True, the file is used in place through a memory map and
+        elements are decoded on demand. Otherwise it is read into a DictParents.
+        """
+        snapshot = SnapshotParents(path)
+        if mmap:
+            uf = cls(parents=snapshot)
+            uf._journal_seq = snapshot.journal_seq
+            return uf
+        parents = DictParents()
+        roots = []
+        for obj, el in snapshot.items():
+            parents._parents[obj] = el
+            parents._next[obj] = obj
+            if el['parent'] != obj:
+                roots.append((el['parent'], obj))
+        for root, obj in roots:  # paths are compressed in the snapshot, so each parent is a root
+            parents.link_members(root, obj)
+        snapshot.close()
+        uf = cls(parents=parents)
+        uf._journal_seq = snapshot.journal_seq
+        return uf
+
+    def members(self, obj):
+        """
+        Return the list of objects in the set containing the object.
+        """
+        root = self[obj]
+        if self.parents.tracks_members:  # walk the member list, in time proportional to the set size
+            return list(self.parents.iter_members(root))
+        return [item[0] for item in self.items() if item[1] == root]
+
     def iter_sets(self):
         """
         Returns all the disjoints sets. Each set is returned as a list.
         """
-        self.items()  # compress all the paths so that it's guaranteed that sets are complete
-        return self.parents.iter_children()
+        if self.parents.tracks_members:
+            return self.parents.iter_children()
+        # a single scan of the engine, the roots are resolved in memory
+        roots = _roots_of(dict((obj, el['parent']) for obj, el in self.parents.items()))[0]
+        sets = {}
+        for obj, root in roots.items():
+            sets.setdefault(root, []).append(obj)
+        return iter(sets.values())
+
+
+class _SharedLock(object):
+    """
+    A lock held by many threads in shared mode, or by a single thread in exclusive mode.
+    The thread holding it in exclusive mode may take it again, in either mode.
+    Threads waiting for exclusive mode take precedence over new shared holders.
+    """
+    def __init__(self):
+        import threading
+        self._cond = threading.Condition(threading.Lock())
+        self._current_thread = threading.current_thread
+        self._shared = 0
+        self._owner = None
+        self._depth = 0  # times the owner took it in exclusive mode
+        self._waiting = 0
+
+    def acquire_shared(self):
+        with self._cond:
+            if self._owner is not self._current_thread():
+                while self._owner is not None or self._waiting:
+                    self._cond.wait()
+            self._shared += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._shared -= 1
+            if not self._shared:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            if self._owner is not self._current_thread():
+                self._waiting += 1
+                while self._owner is not None or self._shared:
+                    self._cond.wait()
+                self._waiting -= 1
+                self._owner = self._current_thread()
+            self._depth += 1
+
+    def release_exclusive(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._cond.notify_all()
+
+
+class ConcurrentUnionFind(UnionFind):
+    """Union-find data structure that can be shared by many threads.
+
+    Finds and unions only hold a shared lock, which does not exclude one another.
+    Finds walk and compress paths without locking: compression only makes an
+    object point to one of its ancestors, which stays valid while other threads
+    link roots.
+    Unions lock the stripes of the roots they merge, in a fixed order, and
+    check that the roots are still roots before linking them. New objects
+    are added under a separate lock. Deunions, consolidations and snapshots
+    wait for the other operations to end, and block them while they run.
+    Engines must tolerate concurrent calls, which CachedParents does not.
+    """
+    def __init__(self, db=None, collection=None, storage='mongodb', parents=None, stripes=64, **extra_fields):
+        """Create a new empty union-find structure.
+
+        Parameters
+        :param stripes: the number of locks that roots are spread across
+        """
+        import threading
+        UnionFind.__init__(self, db, collection, storage, parents, **extra_fields)
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._insert_lock = threading.Lock()
+        self._sets_lock = threading.Lock()  # guards the number of sets and the heap of the largest sets
+        self._rw = _SharedLock()  # only taken in exclusive mode by operations that break paths
+
+    def _insert(self, obj):
+        """Add the unknown object as a singleton. Return False if another thread added it in the meantime."""
+        with self._insert_lock:
+            if obj in self.parents:
+                return False
+            return UnionFind._insert(self, obj)
+
+    def _insert_many(self, objects):
+        """Add the unknown objects as singletons. Return the set of those added, leaving out those added
+        by another thread in the meantime.
+        """
+        with self._insert_lock:
+            return UnionFind._insert_many(self, [obj for obj in objects if obj not in self.parents])
+
+    def _sets_changed(self, delta, weights):
+        with self._sets_lock:
+            UnionFind._sets_changed(self, delta, weights)
+
+    def _root(self, obj):
+        """Return the root of the object, adding it first if it is unknown."""
+        if obj not in self.parents and self._insert(obj):
+            return obj
+        return self._find(obj)
+
+    def __getitem__(self, obj):
+        """Find and return the name of the set containing the object."""
+        self._rw.acquire_shared()
+        try:
+            return self._root(obj)
+        finally:
+            self._rw.release_shared()
+
+    def find_many(self, objects):
+        """Return the list of the names of the sets containing each object, adding unknown objects."""
+        self._rw.acquire_shared()
+        try:
+            return UnionFind.find_many(self, objects)
+        finally:
+            self._rw.release_shared()
+
+    def union(self, *objects):
+        """Find the sets containing the objects and merge them all."""
+        if self._stats is not None:
+            start = timer()
+        self._rw.acquire_shared()
+        try:
+            while True:
+                roots = set([self._root(x) for x in objects])
+                if len(roots) < 2:
+                    break
+                stripes = sorted(set(hash(r) % len(self._stripes) for r in roots))
+                for i in stripes:
+                    self._stripes[i].acquire()
+                try:
+                    # another thread may have linked one of the roots in the meantime
+                    if all(self.parents.parent_of(r) == r for r in roots):
+                        self._link(roots)
+                        break
+                finally:
+                    for i in reversed(stripes):
+                        self._stripes[i].release()
+        finally:
+            self._rw.release_shared()
+        if self._stats is not None:
+            self._stats.record_union(timer() - start)
+        if self._journal is not None:
+            self._journal.append('union', objects)
+
+    def union_edges(self, src, dst=None, batch_size=65536):
+        """Merge the sets at the two ends of each edge, one edge at a time."""
+        for a, b in _iter_edges(src, dst):
+            self.union(a, b)
+
+    def _exclusive(method):
+        def wrapper(self, *args, **kwargs):
+            self._rw.acquire_exclusive()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._rw.release_exclusive()
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    deunion_many = _exclusive(UnionFind.deunion_many)
+    _count_sets = _exclusive(UnionFind._count_sets)
+    largest = _exclusive(UnionFind.largest)
+    checkpoint = _exclusive(UnionFind.checkpoint)
+    rollback = _exclusive(UnionFind.rollback)
+    commit = _exclusive(UnionFind.commit)
+    consolidate = _exclusive(UnionFind.consolidate)
+    save = _exclusive(UnionFind.save)
+    del _exclusive
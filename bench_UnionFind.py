@@ -0,0 +1,217 @@
+"""bench_UnionFind.py
+Benchmarks of the union-find engines on synthetic workloads.
+
+Each workload is a list of operations, ('union', a, b) or ('find', a), run
+against a fresh UnionFind on each backend. Results are printed as JSON, with
+throughput, latency percentiles, peak memory and the number of calls made to
+the Parents interface, i.e., the round trips a database backend would make.
+Each cell is run `--repeat` times and timed by its fastest run, which is the
+figure compared with a previous output.
+
+    python bench_UnionFind.py --size 100000 --output bench_output.txt
+    python bench_UnionFind.py --compare bench_output.txt  # exits with 1 on regressions
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from UnionFind import UnionFind, ArrayParents, CachedParents, DictParents, InstrumentedParents, SQLiteParents, \
+    TieredParents
+
+timer = time.perf_counter
+
+
+# workloads: each function returns a list of operations over `n` elements
+
+def random_graph(n, rnd):
+    return [('union', rnd.randrange(n), rnd.randrange(n)) for _ in range(n)] + \
+           [('find', rnd.randrange(n)) for _ in range(n)]
+
+
+def chain(n, rnd):
+    return [('union', i, i + 1) for i in range(n - 1)] + [('find', rnd.randrange(n)) for _ in range(n)]
+
+
+def star(n, rnd):
+    return [('union', 0, i) for i in range(1, n)] + [('find', rnd.randrange(n)) for _ in range(n)]
+
+
+def power_law(n, rnd):
+    # a few hubs take part in most of the edges
+    def pick():
+        return min(int(rnd.paretovariate(1.2)) - 1, n - 1)
+    return [('union', pick(), rnd.randrange(n)) for _ in range(n)] + [('find', pick()) for _ in range(n)]
+
+
+def union_heavy(n, rnd):
+    return [('union', rnd.randrange(n), rnd.randrange(n)) if rnd.random() < 0.9 else ('find', rnd.randrange(n))
+            for _ in range(2 * n)]
+
+
+def find_heavy(n, rnd):
+    return [('union', rnd.randrange(n), rnd.randrange(n)) if rnd.random() < 0.1 else ('find', rnd.randrange(n))
+            for _ in range(2 * n)]
+
+
+workloads = {
+    'random': random_graph,
+    'chain': chain,
+    'star': star,
+    'power_law': power_law,
+    'union_heavy': union_heavy,
+    'find_heavy': find_heavy,
+}
+
+
+def tiered():
+    # a spill file of its own, removed by close_parents()
+    return TieredParents(os.path.join(tempfile.mkdtemp(prefix='bench_UnionFind'), 'spill'), memory_nodes=1000)
+
+
+backends = {
+    'dict': DictParents,
+    'array': ArrayParents,
+    'array_interned': lambda: ArrayParents(interned=True),
+    'cached_dict': lambda: CachedParents(DictParents(), size=1000),
+    'sqlite': lambda: SQLiteParents(sqlite3.connect(':memory:'), 'bench'),
+    'tiered': tiered,
+}
+
+
+def close_parents(parents):
+    """ Release the connection or the spill file of a backend. """
+    if isinstance(parents, InstrumentedParents):
+        parents = parents.parents
+    if isinstance(parents, TieredParents):
+        parents.close()
+        shutil.rmtree(os.path.dirname(parents.path))
+    elif isinstance(parents, SQLiteParents):
+        parents.db.close()
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def run(ops, make_parents):
+    """ Run the operations and return the elapsed time and the sorted latency of each operation. """
+    parents = make_parents()
+    try:
+        uf = UnionFind(parents=parents)
+        latencies = []
+        start = timer()
+        for op in ops:
+            t = timer()
+            if op[0] == 'union':
+                uf.union(op[1], op[2])
+            else:
+                uf[op[1]]
+            latencies.append(timer() - t)
+        elapsed = timer() - start
+    finally:
+        close_parents(parents)
+    latencies.sort()
+    return elapsed, latencies
+
+
+def profile(ops, make_parents):
+    """ Run the operations again, tracing allocations and counting the calls to the backend.
+    Return the peak memory in bytes and the calls made to each method of the Parents interface.
+    """
+    instrumented = []
+
+    def make_instrumented():
+        instrumented.append(InstrumentedParents(make_parents()))
+        return instrumented[-1]
+
+    tracemalloc.start()
+    try:
+        run(ops, make_instrumented)
+        return tracemalloc.get_traced_memory()[1], instrumented[0].calls
+    finally:
+        tracemalloc.stop()
+
+
+def best_run(ops, make_parents, repeat):
+    """ Run the operations `repeat` times and return the elapsed time and the latencies of the fastest run. """
+    return min(run(ops, make_parents) for _ in range(repeat))
+
+
+def bench(size, seed, workload_names, backend_names, repeat=5):
+    results = []
+    for w_name in workload_names:
+        ops = workloads[w_name](size, random.Random(seed))
+        for b_name in backend_names:
+            elapsed, latencies = best_run(ops, backends[b_name], repeat)
+            memory, calls = profile(ops, backends[b_name])
+            result = {
+                'workload': w_name,
+                'backend': b_name,
+                'size': size,
+                'operations': len(ops),
+                'repeat': repeat,
+                'seconds': elapsed,
+                'ops_per_second': len(ops) / elapsed,
+                'latency_us': dict(('p%d' % p, 1e6 * percentile(latencies, p)) for p in [50, 90, 99, 100]),
+                'peak_memory_bytes': memory,
+                'backend_calls': calls,
+            }
+            results.append(result)
+    return results
+
+
+def import_time(repeat=5):
+    """ Return the best time, in seconds, to import UnionFind in a fresh interpreter. """
+    code = 'import time; t = time.perf_counter(); import UnionFind; print(time.perf_counter() - t)'
+    here = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=here)) for _ in range(repeat))
+
+
+def regressions(results, baseline, tolerance):
+    """ Return the results whose throughput dropped by more than `tolerance` from the baseline. """
+    previous = dict(((r['workload'], r['backend']), r) for r in baseline)
+    slower = []
+    for r in results:
+        old = previous.get((r['workload'], r['backend']))
+        if old is not None and r['ops_per_second'] < (1 - tolerance) * old['ops_per_second']:
+            slower.append({'workload': r['workload'], 'backend': r['backend'],
+                           'ops_per_second': r['ops_per_second'], 'baseline_ops_per_second': old['ops_per_second']})
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=20000, help='number of elements of each workload')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workloads', nargs='+', default=sorted(workloads), choices=sorted(workloads))
+    parser.add_argument('--backends', nargs='+', default=sorted(backends), choices=sorted(backends))
+    parser.add_argument('--output', help='write the results to this file instead of the standard output')
+    parser.add_argument('--compare', help='a previous output; exit with status 1 if throughput regressed')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='accepted throughput drop, as a fraction')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each cell, timed by the fastest one')
+    args = parser.parse_args(argv)
+
+    results = bench(args.size, args.seed, args.workloads, args.backends, args.repeat)
+    report = {'python': sys.version.split()[0], 'import_seconds': import_time(), 'results': results}
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = regressions(results, json.load(f)['results'], args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import asyncio
+import random
+import time
+import unittest
+from AsyncUnionFind import AsyncUnionFind
+from UnionFind import UnionFind
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+class AsyncUnionFindTestCase(unittest.TestCase):
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.uf = AsyncUnionFind()
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+
+    async def _items(self):
+        return dict([item async for item in self.uf.items()])
+
+    def test_union(self):
+        guys = ['nathan', 'mike', 'john', 'albert']
+        for guy in guys:
+            assert run(self.uf.find(guy)) == guy
+        run(self.uf.union('nathan', 'mike'))
+        run(self.uf.union('john', 'albert'))
+        assert run(self.uf.find('mike')) == run(self.uf.find('nathan'))
+        assert run(self.uf.find('john')) == run(self.uf.find('albert'))
+        assert run(self.uf.find('nathan')) != run(self.uf.find('john'))
+        run(self.uf.union('mike', 'albert', 'walt'))
+        roots = run(self.uf.find_many(guys + ['walt']))
+        assert len(set(roots)) == 1
+        assert run(self.uf.parents.get(roots[0]))['weight'] == 5
+        self.assertSetEqual(set(roots), set(run(self._items()).values()))
+
+    def test_concurrent_unions(self):
+        rnd = random.Random(5)
+        edges = [(rnd.randrange(100), rnd.randrange(100)) for _ in range(300)]
+        expected = UnionFind()
+        expected.union_edges(edges)
+        self.uf.parents.latency = 0.0001
+
+        async def unions():
+            await asyncio.gather(*[self.uf.union(a, b) for a, b in edges])
+        run(unions())
+        items = run(self._items())
+        for a in items:
+            assert run(self.uf.parents.get(items[a]))['weight'] == expected.parents.weight_of(expected[a])
+            for b in list(items)[::9]:
+                assert (items[a] == items[b]) == (expected[a] == expected[b])
+
+    def test_pipelined_finds(self):
+        self.uf.parents.latency = 0.02
+        run(self.uf.find_many(range(10)))
+        start = time.time()
+        run(self.uf.union(*range(10)))  # ten finds, then one link
+        assert time.time() - start < 10 * 0.02
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,17 @@
 __author__ = 'simone'
+import gc
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from UnionFind import UnionFind
+from UnionFind import UnionFind, ArrayParents, CachedParents, ConcurrentUnionFind, DictParents, InstrumentedParents, \
+    Journal, MongoConsolidate, MySQLConsolidate, MySQLPool, ShardedParents, SQLiteParents, TieredParents, available_storage, register_storage
 from pymongo import MongoClient
 import MySQLdb
 
@@ -96,6 +107,262 @@ class UnionFindTestCase(unittest.TestCase):
         assert self.uf['nathan'] == self.uf['nathan']
         assert self.uf['albert'] == self.uf['albert']
 
+    def test_set_parents(self):
+        self.test_insertion()
+        self.uf.parents.set_parents({'nathan': 'albert', 'mike': 'albert'})
+        assert self.uf.parents['nathan']['parent'] == self.uf.parents['mike']['parent'] == 'albert'
+        assert self.uf.parents['nathan']['weight'] == 1
+        assert self.uf['john'] == 'john'
+
+    def test_upsert_many(self):
+        self.test_insertion()
+        self.uf.parents.upsert_many({'nathan': ('albert', 1), 'albert': ('albert', 3), 'zoe': ('albert', 1)})
+        assert self.uf.parents['nathan']['parent'] == self.uf.parents['zoe']['parent'] == 'albert'
+        assert self.uf.parents['albert']['weight'] == 3
+        assert self.uf['zoe'] == self.uf['nathan'] == 'albert'
+        assert self.uf['john'] == 'john'
+
+    def test_union_edges(self):
+        rnd = random.Random(42)
+        edges = [('n%d' % rnd.randrange(50), 'n%d' % rnd.randrange(50)) for _ in range(60)]
+        expected = UnionFind()
+        for a, b in edges:
+            expected.union(a, b)
+        self.uf.union_edges([a for a, b in edges], [b for a, b in edges], batch_size=16)
+        for x in ['n%d' % i for i in range(50)]:
+            if x in expected.parents:
+                # same roots and same weights as union() called pair by pair
+                assert self.uf[x] == expected[x]
+                assert self.uf.parents.weight_of(self.uf[x]) == expected.parents.weight_of(expected[x])
+            else:
+                assert x not in self.uf.parents
+        self.uf.union_edges([('nathan', 'mike'), ('mike', 'john')])
+        assert self.uf['nathan'] == self.uf['mike'] == self.uf['john']
+
+    def test_union_edges_rollback(self):
+        self.uf.union('a', 'b')
+        token = self.uf.checkpoint()
+        self.uf.union_edges([('b', 'c'), ('d', 'e'), ('e', 'a'), ('f', 'f')])
+        assert self.uf.size('d') == 5
+        self.assertSetEqual(set(self.uf.members('c')), set('abcde'))
+        self.uf.rollback(token)
+        assert self.uf.size('a') == 2 and self.uf.size('e') == 1
+        self.assertSetEqual(set(self.uf.members('a')), set('ab'))
+        assert self.uf.num_sets == 5
+
+    def test_find_many(self):
+        # merging pairs, then pairs of pairs and so on leaves paths 4 levels deep
+        guys = ['g%d' % i for i in range(16)]
+        step = 1
+        while step < len(guys):
+            for i in range(0, len(guys), 2 * step):
+                self.uf.union(guys[i], guys[i + step])
+            step *= 2
+        self.uf.enable_stats()
+        roots = self.uf.find_many(guys + ['newbie', 'g3', 'newbie'])
+        stats = self.uf.stats()
+        self.uf.disable_stats()
+        assert stats['backend_calls']['parents_of'] <= 5
+        assert 'parent_of' not in stats['backend_calls']
+        assert stats['inserts'] == 1
+        assert len(roots) == 19
+        assert len(set(roots[:16])) == 1
+        assert roots[16] == roots[18] == 'newbie'
+        for guy in guys:
+            assert self.uf.parents.parent_of(guy) == roots[0]  # compressed
+        assert self.uf.find_many([]) == []
+
+    def test_set_statistics(self):
+        self.test_insertion()
+        assert self.uf.num_sets == 4
+        assert [w for r, w in self.uf.largest(2)] == [1, 1]
+        self.uf.union('nathan', 'mike')
+        self.uf.union('mike', 'albert')
+        assert self.uf.num_sets == 2
+        assert self.uf.size('albert') == 3 and self.uf.size('john') == 1
+        assert self.uf.largest(1) == [(self.uf['nathan'], 3)]
+        self.uf.deunion('mike')
+        assert self.uf.num_sets == 3
+        assert self.uf.largest(5)[0] == (self.uf['nathan'], 2)
+        assert len(self.uf.largest(5)) == 3
+
+        # against a brute force count, with the heap in use all along
+        rnd = random.Random(3)
+        guys = ['r%d' % i for i in range(40)]
+        for i in range(200):
+            if rnd.random() < 0.8:
+                self.uf.union(rnd.choice(guys), rnd.choice(guys))
+            else:
+                self.uf.deunion(rnd.choice(guys))
+            if i % 20 == 0:
+                sizes = {}
+                for obj, root in self.uf.items():
+                    sizes[root] = sizes.get(root, 0) + 1
+                assert self.uf.num_sets == len(sizes)
+                expected = sorted(sizes.values(), reverse=True)[:5]
+                assert [w for r, w in self.uf.largest(5)] == expected
+                for root, w in self.uf.largest(5):
+                    assert sizes[root] == w
+
+    def _partition(self, guys):
+        sets = {}
+        for guy in guys:
+            sets.setdefault(self.uf[guy], set()).add(guy)
+        for root, members in sets.items():
+            assert self.uf.parents.weight_of(root) == len(members)
+        return sorted(sorted(members) for members in sets.values())
+
+    def test_checkpoint_rollback(self):
+        rnd = random.Random(11)
+        guys = ['c%d' % i for i in range(30)]
+        for _ in range(20):
+            self.uf.union(rnd.choice(guys), rnd.choice(guys))
+        before = self._partition(guys)
+        num_sets = self.uf.num_sets
+        largest = [w for r, w in self.uf.largest(3)]
+
+        token = self.uf.checkpoint()
+        for _ in range(30):
+            if rnd.random() < 0.7:
+                self.uf.union(rnd.choice(guys), rnd.choice(guys))
+            else:
+                self.uf.deunion(rnd.choice(guys))
+        inner = self.uf.checkpoint()
+        self.uf.union(*guys)
+        assert self.uf.num_sets == 1
+        self.uf.rollback(inner)
+        after_inner = self._partition(guys)
+        assert len(after_inner) > 1
+        self.uf.rollback(token)
+
+        assert self._partition(guys) == before
+        assert self.uf.num_sets == num_sets
+        assert [w for r, w in self.uf.largest(3)] == largest
+        for guy in guys:
+            self.assertSetEqual(set(self.uf.members(guy)), set(x for x in guys if self.uf[x] == self.uf[guy]))
+        self.assertRaises(ValueError, self.uf.rollback, token)
+
+        token = self.uf.checkpoint(compress=True)
+        self.uf.union('c1', 'new')
+        self.uf.commit(token)
+        assert self.uf['new'] == self.uf['c1']
+
+    def test_deunion_in_checkpoint(self):
+        guys = ['d%d' % i for i in range(8)]
+        token = self.uf.checkpoint()
+        step = 1
+        while step < len(guys):  # paths are not compressed, pairs of pairs leave them 3 levels deep
+            for i in range(0, len(guys), 2 * step):
+                self.uf.union(guys[i], guys[i + step])
+            step *= 2
+        victim = self.uf.parents.parent_of('d0')
+        assert victim != self.uf['d0']  # an interior element
+        self.uf.deunion(victim)
+        rest = [guy for guy in guys if guy != victim]
+        assert len(set(self.uf[guy] for guy in rest)) == 1
+        assert self.uf.size(rest[0]) == 7
+        self.assertListEqual(self.uf.members(victim), [victim])
+        self.uf.rollback(token)
+        assert self.uf.num_sets == 8
+
+    def test_nested_checkpoints(self):
+        # no change is logged between the two checkpoints
+        outer = self.uf.checkpoint()
+        inner = self.uf.checkpoint()
+        assert outer != inner
+        self.uf.union('a', 'c')
+        self.uf.commit(inner)
+        self.uf.union('b', 'd')
+        self.uf.rollback(outer)
+        assert self.uf['a'] != self.uf['c'] and self.uf['b'] != self.uf['d']
+        self.assertRaises(ValueError, self.uf.rollback, outer)
+
+    def test_deunion_many(self):
+        rnd = random.Random(7)
+        guys = ['g%d' % i for i in range(30)]
+        for _ in range(40):
+            self.uf.union(rnd.choice(guys), rnd.choice(guys))
+        sets = dict((guy, set(self.uf.members(guy))) for guy in guys)
+        removed = rnd.sample(guys, 8)
+        self.uf.deunion_many(removed)
+        for guy in guys:
+            if guy in removed:
+                expected = set([guy])
+            else:
+                expected = sets[guy] - set(removed)
+            self.assertSetEqual(expected, set(x for x in guys if self.uf[x] == self.uf[guy]))
+            # root weights are still the sizes of the sets
+            assert self.uf.parents.weight_of(self.uf[guy]) == len(expected)
+
+    def test_members(self):
+        self.test_union()
+        self.assertSetEqual(set(['nathan', 'mike', 'john', 'albert']), set(self.uf.members('john')))
+        self.uf.union('zack', 'yuri')
+        self.assertSetEqual(set(['zack', 'yuri']), set(self.uf.members('yuri')))
+        assert self.uf.members('walt') == ['walt']
+        self.uf.deunion('mike')
+        self.assertSetEqual(set(['nathan', 'john', 'albert']), set(self.uf.members('albert')))
+        assert self.uf.members('mike') == ['mike']
+
+    def test_save_load(self):
+        self.test_union()
+        self.uf.union('zack', 'yuri')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'uf.snapshot')
+            self.uf.save(path)
+            for mmap in [True, False]:
+                uf2 = UnionFind.load(path, mmap=mmap)
+                for guy in ['nathan', 'mike', 'john', 'albert', 'zack', 'yuri']:
+                    assert uf2[guy] == self.uf[guy]
+                    assert uf2.parents.weight_of(uf2[guy]) == self.uf.parents.weight_of(self.uf[guy])
+                assert 'walt' not in uf2.parents
+                # the loaded structure can be changed, leaving the file untouched
+                uf2.union('walt', 'zack')
+                uf2.deunion('mike')
+                assert uf2['walt'] == uf2['yuri'] != uf2['nathan'] != uf2['mike']
+                assert uf2.parents.weight_of(uf2['walt']) == 3
+            uf3 = UnionFind.load(path)
+            assert 'walt' not in uf3.parents
+            assert uf3['mike'] == uf3['nathan']
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_union_edges_parallel(self):
+        rnd = random.Random(3)
+        edges = [('n%d' % rnd.randrange(80), 'n%d' % rnd.randrange(80)) for _ in range(70)]
+        expected = UnionFind()
+        expected.union_edges(edges)
+        self.uf.union_edges_parallel(edges, workers=2, chunk_size=10)
+        for a in ['n%d' % i for i in range(80)]:
+            assert (a in self.uf.parents) == (a in expected.parents)
+            if a in expected.parents:
+                assert self.uf.parents.weight_of(self.uf[a]) == expected.parents.weight_of(expected[a])
+                for b in ['n%d' % i for i in range(0, 80, 7)]:
+                    if b in expected.parents:
+                        assert (self.uf[a] == self.uf[b]) == (expected[a] == expected[b])
+
+    def test_stats(self):
+        assert self.uf.stats() is None
+        events = []
+        self.uf.enable_stats(callback=lambda event, value: events.append(event))
+        self.uf.union('nathan', 'mike')
+        self.uf.union('john', 'albert')
+        self.uf.union('mike', 'albert')
+        self.uf['john']
+        stats = self.uf.stats()
+        assert stats['inserts'] == 4
+        assert stats['unions'] == 3 and stats['linked_roots'] == 6
+        assert stats['inc_weight'] == 3
+        assert stats['finds'] >= 3 and stats['max_hops'] >= 1
+        lookup = 'find_path' if self.uf.parents.server_side_find else '__contains__'
+        assert stats['backend_calls'][lookup] >= 7
+        assert sum(stats['union_latency_us'].values()) == 3
+        assert 'find' in events and 'link' in events and 'inc_weight' in events
+        self.uf.disable_stats()
+        assert self.uf.stats() is None
+        assert self.uf['john'] == self.uf['nathan']
+
     def test_iter_sets(self):
         self.test_deunion()
         self.uf.deunion('albert', 'john', 'mike', 'nathan')
@@ -118,6 +385,659 @@ class UnionFindTestCase(unittest.TestCase):
                 assert set(['nathan']) == set(el)
 
 
+class ArrayUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.uf = UnionFind(storage='array')
+
+    def test_integer_ids(self):
+        uf = UnionFind(parents=ArrayParents())
+        assert uf[5] == 5
+        assert 5 in uf.parents and 3 not in uf.parents and 100 not in uf.parents
+        uf.union(1, 2)
+        uf.union(3, 4)
+        uf.union(2, 4)
+        assert uf[1] == uf[2] == uf[3] == uf[4] != uf[5]
+        assert uf.parents[uf[1]]['weight'] == 4
+        uf.union(1000, 1)  # arrays grow to make room for new ids
+        assert uf[1000] == uf[4]
+        assert uf.parents[uf[1000]]['weight'] == 5
+        self.assertSetEqual(set([1, 2, 3, 4, 5, 1000]), set(k for k, v in uf.items()))
+
+    def test_paths(self):
+        for parents, keys, unknown in [(ArrayParents(), [3, 1, 0, 2], 7),
+                                       (ArrayParents(interned=True), ['d', 'b', 'a', 'c'], 'e')]:
+            for key in keys:
+                parents[key] = key
+            for child, parent in zip(keys, keys[1:]):
+                parents[child] = parent
+            assert parents.find_path(keys[0]) == keys
+            assert parents.find_path(keys[-1]) == keys[-1:]
+            assert parents.parents_of(keys[:2] + [unknown]) == {keys[0]: keys[1], keys[1]: keys[2]}
+
+
+class TieredUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uf = UnionFind(parents=TieredParents(os.path.join(self.tmpdir, 'uf.spill'), memory_nodes=4))
+
+    def tearDown(self):
+        self.uf.parents.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_spill(self):
+        rnd = random.Random(5)
+        expected = UnionFind()
+        for _ in range(300):
+            a, b = rnd.randrange(200), rnd.randrange(200)
+            self.uf.union(a, b)
+            expected.union(a, b)
+            assert len(self.uf.parents._hot) <= 4
+        assert self.uf.parents.spills > 0 and self.uf.parents.faults > 0
+        for x in range(200):
+            assert (x in self.uf.parents) == (x in expected.parents)
+        for x in range(200):
+            if x in expected.parents:
+                assert self.uf.members(x) and set(self.uf.members(x)) == set(expected.members(x))
+                assert self.uf.size(x) == expected.size(x)
+        assert sorted(k for k, v in self.uf.items()) == sorted(k for k, v in expected.items())
+
+    def test_roots_stay_in_memory(self):
+        parents = self.uf.parents
+        for i in range(1, 4):
+            self.uf.union(0, i)
+        root = parents.parent_of(0)
+        others = [i for i in range(4) if i != root]
+        for i in others:
+            parents.parent_of(i)  # the root is now the least recently used
+        self.uf[4]
+        assert root in parents._hot and others[0] not in parents._hot
+        assert parents.spills == 1
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'uf.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, uf, rnd):
+        guys = ['j%d' % i for i in range(40)]
+        for _ in range(50):
+            uf.union(rnd.choice(guys), rnd.choice(guys))
+        uf.deunion(rnd.choice(guys), rnd.choice(guys))
+        uf.union_edges([(rnd.choice(guys), rnd.choice(guys)) for _ in range(20)], batch_size=8)
+        token = uf.checkpoint()
+        uf.union(*guys)
+        uf.rollback(token)
+        return guys
+
+    def test_replay(self):
+        uf = UnionFind()
+        with Journal(self.path, sync_interval=60, sync_bytes=256) as journal:
+            assert uf.attach_journal(journal) == 0
+            guys = self._run(uf, random.Random(1))
+            assert journal.syncs > 0 and journal.records == 50 + 1 + 3 + 3
+        uf2 = UnionFind()
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 57
+        for guy in guys:
+            assert uf2[guy] == uf[guy]
+            assert uf2.size(guy) == uf.size(guy)
+
+    def test_torn_write(self):
+        uf = UnionFind()
+        with Journal(self.path) as journal:
+            uf.attach_journal(journal)
+            uf.union('a', 'b')
+            uf.union('c', 'd')
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(size - 3)  # the last record was being written during a crash
+        uf2 = UnionFind()
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 1
+            uf2.union('e', 'f')
+        uf3 = UnionFind()
+        with Journal(self.path) as journal:
+            assert uf3.attach_journal(journal) == 2  # new records follow the good ones
+        assert uf3['a'] == uf3['b'] and uf3['e'] == uf3['f'] and uf3['c'] != uf3['d']
+
+    def test_truncate_on_save(self):
+        snapshot = os.path.join(self.tmpdir, 'uf.snapshot')
+        uf = UnionFind()
+        with Journal(self.path) as journal:
+            uf.attach_journal(journal)
+            uf.union('a', 'b')
+            uf.save(snapshot)
+            assert journal.replay(UnionFind()) == 0  # only a marker is left
+            uf.union('b', 'c')
+        uf2 = UnionFind.load(snapshot, mmap=False)
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 1
+        assert uf2['a'] == uf2['b'] == uf2['c']
+        assert uf2.detach_journal() is journal
+
+    def test_crash_before_truncate(self):
+        snapshot = os.path.join(self.tmpdir, 'uf.snapshot')
+        uf = UnionFind()
+        with Journal(self.path) as journal:
+            uf.attach_journal(journal)
+            uf.union('a', 'b', 'c')
+            uf.deunion('a')
+            journal.sync()
+            shutil.copy(self.path, self.path + '.old')
+            uf.save(snapshot)
+        # a crash between the rename of the snapshot and the truncation of the journal
+        shutil.copy(self.path + '.old', self.path)
+        uf2 = UnionFind.load(snapshot, mmap=False)
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 0  # already in the snapshot
+            uf2.union('a', 'd')
+        uf3 = UnionFind.load(snapshot)
+        with Journal(self.path) as journal:
+            assert uf3.attach_journal(journal) == 1  # numbering goes on after the old records
+        assert uf3['b'] == uf3['c'] != uf3['a'] == uf3['d']
+        assert uf3.size('b') == 2
+
+    def test_failed_operations(self):
+        uf = UnionFind()
+        with Journal(self.path) as journal:
+            uf.attach_journal(journal)
+            uf.union('a', 'b')
+            self.assertRaises(TypeError, uf.union, 'a', ['unhashable'])
+            self.assertRaises(ValueError, uf.rollback, 3)
+            assert journal.records == 1
+        uf2 = UnionFind()
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 1
+        assert uf2['a'] == uf2['b']
+
+    def test_idle_sync(self):
+        with Journal(self.path, sync_interval=0.01) as journal:
+            journal.append('union', ('a', 'b'))
+            time.sleep(0.2)  # no further append
+            assert journal.syncs >= 1
+            assert os.path.getsize(self.path) > 0
+
+    def test_save_with_open_checkpoint(self):
+        snapshot = os.path.join(self.tmpdir, 'uf.snapshot')
+        uf = UnionFind()
+        with Journal(self.path) as journal:
+            uf.attach_journal(journal)
+            token = uf.checkpoint()
+            uf.union('a', 'b')
+            self.assertRaises(ValueError, uf.save, snapshot)
+            uf.rollback(token)
+            uf.save(snapshot)
+        uf2 = UnionFind.load(snapshot, mmap=False)
+        with Journal(self.path) as journal:
+            assert uf2.attach_journal(journal) == 0
+        assert uf2['a'] != uf2['b']
+
+
+class StorageRegistryTestCase(unittest.TestCase):
+    def test_lazy_drivers(self):
+        # heapq is left out, since collections imports it on python 2
+        code = 'import sys, UnionFind; ' \
+               'print(sorted(m for m in ["pymongo", "MySQLdb", "sqlite3", "multiprocessing", "pickle", "struct", ' \
+               '"threading", "mmap", "zlib"] if m in sys.modules))'
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.strip(), b'[]')
+
+    def test_register_storage(self):
+        calls = []
+
+        def factory(db, collection, **options):
+            calls.append((db, collection, options))
+            return DictParents()
+        register_storage('test_registry', factory)
+        assert 'test_registry' in available_storage
+        uf = UnionFind('a_db', 'a_collection', storage='test_registry', role='player')
+        uf.union('a', 'b')
+        assert uf['a'] == uf['b']
+        self.assertListEqual(calls, [('a_db', 'a_collection', {'role': 'player'})])
+
+    def test_fallback(self):
+        assert isinstance(UnionFind(storage='unknown').parents, DictParents)
+        assert isinstance(UnionFind(storage='sqlite').parents, DictParents)  # no database
+        assert isinstance(UnionFind(storage='array').parents, ArrayParents)
+        assert isinstance(UnionFind(sqlite3.connect(':memory:'), 'uf', storage='sqlite').parents, SQLiteParents)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    class Connection(object):
+        """ Stands in for a MySQLdb connection, each query returns its arguments as rows. """
+        def __init__(self):
+            self.commits = 0
+
+        def cursor(self, cursorclass=None):
+            class Cursor(object):
+                def execute(self, query, args=None):
+                    time.sleep(0.01)
+                    self.rows = list(args or ())
+                    return len(self.rows)
+
+                def fetchall(self):
+                    return self.rows
+
+                def close(self):
+                    pass
+            return Cursor()
+
+        def autocommit(self, on):
+            pass
+
+        def commit(self):
+            self.commits += 1
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+    def test_bounded(self):
+        opened = []
+
+        def connect():
+            opened.append(self.Connection())
+            return opened[-1]
+        pool = MySQLPool(connect, size=2)
+        threads = [threading.Thread(target=pool.execute, args=('SELECT %s', (i,))) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(opened) == 2
+        assert pool.queries == pool.acquisitions == 8
+        assert pool.waits > 0 and pool.wait_seconds > 0
+        self.assertListEqual(pool.execute('SELECT %s', (1,)), [1])
+        assert pool.execute('UPDATE', (1, 2), write=True) == 2
+        assert sum(conn.commits for conn in opened) == 0  # autocommit
+
+    def test_timeout(self):
+        pool = MySQLPool(self.Connection, size=1, timeout=0.05, autocommit=False)
+        conn = pool.acquire()
+        self.assertRaises(RuntimeError, pool.execute, 'SELECT 1')
+        pool.release(conn)
+        pool.execute('UPDATE', (1,), write=True)
+        assert conn.commits == 1
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'uf.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, keys):
+        uf = UnionFind()
+        for k in keys:
+            uf[k]
+        for a, b in zip(keys[::3], keys[1::3]):
+            uf.union(a, b)
+        uf.save(self.path)
+        uf2 = UnionFind.load(self.path)
+        self.assertSetEqual(set(keys), set(k for k, v in uf2.items()))
+        for k in keys:
+            assert uf2[k] == uf[k]
+        assert 'missing' not in uf2.parents and -1 not in uf2.parents
+
+    def test_integer_keys(self):
+        self._check(list(range(100, 0, -1)))
+
+    def test_string_keys(self):
+        self._check([u'k\xe9y%d' % i for i in range(100)])
+
+    def test_other_keys(self):
+        self._check([(i, 'x') for i in range(100)])
+
+
+class ConcurrentUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.uf = ConcurrentUnionFind(stripes=8)
+
+    def _run(self, target, n_threads):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+            assert not thread.is_alive()  # a cycle in the parents would never end
+
+    def _check_sets(self, uf, expected, elements):
+        for a in elements:
+            assert uf.parents.weight_of(uf[a]) == expected.parents.weight_of(expected[a])
+            for b in elements[::11]:
+                assert (uf[a] == uf[b]) == (expected[a] == expected[b])
+
+    def test_stress_union(self):
+        rnd = random.Random(11)
+        elements = list(range(500))
+        edges = [(rnd.choice(elements), rnd.choice(elements)) for _ in range(2000)]
+        expected = UnionFind()
+        expected.union_edges(edges)
+
+        def work(i):
+            for a, b in edges[i::8]:
+                self.uf.union(a, b)
+                self.uf[rnd.choice(elements)]
+        self._run(work, 8)
+        self._check_sets(self.uf, expected, elements)
+
+    def test_stress_deunion(self):
+        elements = list(range(200))
+        removed = elements[::10]
+        kept = [a for a in elements if a not in removed]
+        for a in elements:
+            self.uf.union(1000 + a % 20, a)
+
+        def work(i):
+            if i == 0:
+                for a in removed:
+                    self.uf.deunion(a)
+            else:
+                for a in kept[i::7]:
+                    self.uf.union(1000 + a % 3, a)
+                    self.uf[a]
+        self._run(work, 7)
+        expected = UnionFind()
+        for a in elements:
+            expected.union(1000 + a % 20, a)
+        expected.deunion(*removed)
+        for a in kept:
+            expected.union(1000 + a % 3, a)
+        self._check_sets(self.uf, expected, elements)
+
+    def test_concurrent_reads(self):
+        # finds on a backend that blocks on I/O run side by side
+        class SlowParents(DictParents):
+            def parent_of(self, obj):
+                time.sleep(0.002)
+                return DictParents.parent_of(self, obj)
+
+            def find_path(self, obj):
+                time.sleep(0.002)
+                return DictParents.find_path(self, obj)
+
+        uf = ConcurrentUnionFind(parents=SlowParents())
+        uf.union(*range(10))
+
+        def work(i):
+            for a in range(10):
+                uf[a]
+        start = time.time()
+        work(0)
+        serial = time.time() - start
+        start = time.time()
+        self._run(work, 8)
+        assert time.time() - start < 8 * serial / 2
+
+
+class DirtyTrackingTestCase(unittest.TestCase):
+    def test_dirty(self):
+        uf = UnionFind()
+        uf.union('alpha', 'bravo')
+        assert uf.parents._dirty is None  # not tracked before the first consolidation
+        db = sqlite3.connect(':memory:')
+        assert uf.consolidate(db, 'unionfind', incremental=True) == 2
+        assert not uf.parents._dirty
+        uf['alpha']
+        assert not uf.parents._dirty  # finds on compressed paths change nothing
+        uf.union('charlie', 'alpha')
+        self.assertSetEqual(set(['charlie', uf['alpha']]), uf.parents._dirty)
+        assert uf.consolidate(db, 'unionfind', incremental=True) == 2
+        assert db.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] == 3
+
+
+class CachedUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.backend = DictParents()
+        self.uf = UnionFind(parents=CachedParents(self.backend, size=3))
+
+    def test_write_back(self):
+        with self.uf.parents as cache:
+            self.uf.union('alpha', 'bravo', 'charlie')
+            self.uf.union('delta', 'echo')
+            self.uf.union('alpha', 'echo')
+        assert cache.evictions > 0 and cache.flushes > 0 and cache.misses > 0
+        assert not cache.cache_info()['dirty']
+        # the wrapped parents hold the same sets and weights
+        backend = UnionFind(parents=self.backend)
+        root = backend['alpha']
+        for guy in ['bravo', 'charlie', 'delta', 'echo']:
+            assert backend[guy] == root
+        assert self.backend[root]['weight'] == 5
+
+    def test_hits(self):
+        self.uf.union('alpha', 'bravo')
+        hits = self.uf.parents.hits
+        self.uf['alpha']
+        assert self.uf.parents.hits > hits
+        assert len(self.backend._parents) == 0  # nothing written back yet
+        self.uf.parents.flush()
+        assert len(self.backend._parents) == 2
+
+    def test_flush_upserts(self):
+        backend = InstrumentedParents(self.backend)
+        uf = UnionFind(parents=CachedParents(backend, size=100))
+        uf.union('alpha', 'bravo', 'charlie')
+        uf.parents.flush()
+        # the misses read the wrapped parents, the flush writes them with a single call
+        assert set(backend.calls) == set(['__getitem__', 'upsert_many']) and backend.calls['upsert_many'] == 1
+        assert self.backend['bravo']['parent'] == self.backend['charlie']['parent'] == uf['alpha']
+        assert self.backend[uf['alpha']]['weight'] == 3
+
+    def test_members_write_back(self):
+        for backend in [DictParents(), ArrayParents(interned=True)]:
+            uf = UnionFind(parents=CachedParents(backend, size=2))
+            uf.union('a', 'b')
+            uf.union('b', 'c')
+            uf.union('d', 'e')
+            uf.parents.flush()
+            self.assertListEqual(sorted(uf.members('a')), ['a', 'b', 'c'])
+            self.assertListEqual(sorted(sorted(s) for s in uf.iter_sets()), [['a', 'b', 'c'], ['d', 'e']])
+            uf.deunion('b')
+            self.assertListEqual(sorted(uf.members('a')), ['a', 'c'])
+            self.assertListEqual(uf.members('b'), ['b'])
+            assert uf.size('a') == 2 and uf.size('b') == 1
+            # the wrapped parents hold the same member lists
+            self.assertListEqual(sorted(UnionFind(parents=backend).members('c')), ['a', 'c'])
+
+
+class SQLiteUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.uf = UnionFind(self.db, 'unionfind', 'sqlite')
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_transactions(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'uf.sqlite')
+            db = sqlite3.connect(path)
+            with SQLiteParents(db, 'unionfind', commit_every=1000) as parents:
+                uf = UnionFind(parents=parents)
+                uf.union('alpha', 'bravo')
+                other = sqlite3.connect(path)
+                # not committed yet
+                assert other.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] == 0
+            assert other.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] == 2
+            assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            other.close()
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_commit_at_exit(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'uf.sqlite')
+            code = ('import sqlite3; from UnionFind import UnionFind; '
+                    'uf = UnionFind(sqlite3.connect(%r), "unionfind", "sqlite"); uf.union("alpha", "bravo")' % path)
+            subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+            db = sqlite3.connect(path)
+            assert db.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] == 2
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_commit_at_exit_hook(self):
+        # a single exit hook keeps the instances alive so far, without holding them
+        module = sys.modules[UnionFind.__module__]
+        alive = module._alive_sqlite_parents
+        many = [SQLiteParents(sqlite3.connect(':memory:'), 'unionfind') for _ in range(10)]
+        assert module._alive_sqlite_parents is alive
+        assert all(parents in alive for parents in many)
+        count = len(alive)
+        for parents in many:
+            parents.db.close()
+        del many, parents
+        gc.collect()
+        assert len(alive) == count - 10
+
+    def test_deunion_round_trips(self):
+        for i in range(1, 200):
+            self.uf.union(i, i // 2)
+        self.uf.enable_stats()
+        self.uf.deunion(7)
+        calls = self.uf.stats()['backend_calls']
+        self.uf.disable_stats()
+        # only the set of 7 is fetched, one level of its tree per call
+        assert 'items' not in calls
+        assert sum(calls.values()) < 30
+        self.assertListEqual(self.uf.members(7), [7])
+        assert self.uf.size(0) == 199
+
+    def test_iter_sets_round_trips(self):
+        for i in range(1, 200):
+            self.uf.union(i, i // 2 if i % 50 else i - 1)
+        self.uf.deunion(50, 100)
+        self.uf.enable_stats()
+        sets = sorted(sorted(s) for s in self.uf.iter_sets())
+        calls = self.uf.stats()['backend_calls']
+        self.uf.disable_stats()
+        assert calls == {'items': 1}
+        assert sorted(len(s) for s in sets) == [1, 1, 198]
+
+
+class SQLiteServerSideUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.uf = UnionFind(self.db, 'unionfind', 'sqlite', server_side_find=True)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_deep_path(self):
+        # a chain left uncompressed, as after a bulk load
+        chain = ['c%d' % i for i in range(50)]
+        for obj in chain:
+            self.uf[obj]
+        self.uf.parents.set_parents(dict(zip(chain[:-1], chain[1:])))
+        self.uf.enable_stats()
+        assert self.uf['c0'] == 'c49'
+        stats = self.uf.stats()
+        self.uf.disable_stats()
+        assert stats['backend_calls'] == {'find_path': 1, 'set_parents': 1}
+        assert stats['hops'] == 49
+        for obj in chain:
+            assert self.uf.parents.parent_of(obj) == 'c49'
+
+
+class SQLiteInternedUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.uf = UnionFind(self.db, 'unionfind', 'sqlite', interned=True, server_side_find=True)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_interned_schema(self):
+        self.test_union()
+        keys = dict(self.db.execute('SELECT id, _key FROM unionfind_keys').fetchall())
+        assert sorted(keys.values()) == ['albert', 'john', 'mike', 'nathan']
+        for _id, parent, weight in self.db.execute('SELECT _id, parent, weight FROM unionfind').fetchall():
+            assert isinstance(_id, int) and isinstance(parent, int)
+            assert self.uf[keys[_id]] == keys[parent] == 'nathan'
+
+        # a fresh instance starts with an empty cache of keys
+        uf2 = UnionFind(self.db, 'unionfind', 'sqlite', interned=True)
+        assert uf2['john'] == 'nathan'
+        assert uf2.find_many(['albert', 'zack']) == ['nathan', 'zack']
+
+
+class ShardedUnionFindTestCase(UnionFindTestCase):
+    def setUp(self):
+        self.dbs = [sqlite3.connect(':memory:', check_same_thread=False) for _ in range(3)]
+        self.uf = UnionFind(parents=ShardedParents([SQLiteParents(db, 'unionfind') for db in self.dbs]))
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+
+    def test_shards(self):
+        guys = ['s%d' % i for i in range(60)]
+        for a, b in zip(guys[::2], guys[1::2]):
+            self.uf.union(a, b)
+        self.uf.union(*guys[:30])
+        counts = [db.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] for db in self.dbs]
+        assert sum(counts) == 60 and all(counts)
+        root = self.uf['s0']
+        assert all(self.uf[guy] == root for guy in guys[:30])
+        assert self.uf.size('s59') == 2
+
+    def test_consolidate_shards(self):
+        uf = UnionFind(parents=ShardedParents([DictParents() for _ in range(3)]))
+        uf.union_edges([('s%d' % i, 's%d' % (i // 2)) for i in range(1, 40)])
+        dbs = [sqlite3.connect(':memory:', check_same_thread=False) for _ in range(3)]
+        assert uf.consolidate(dbs, 'unionfind') == 40
+        uf2 = UnionFind(parents=ShardedParents([SQLiteParents(db, 'unionfind') for db in dbs]))
+        for i in range(40):
+            assert uf2['s%d' % i] == uf['s%d' % i]
+        db = sqlite3.connect(':memory:')
+        assert uf.consolidate(db, 'unionfind') == 40
+        assert [db.execute('SELECT COUNT(*) FROM unionfind_%d' % i).fetchone()[0] for i in range(3)] == \
+               [db.execute('SELECT COUNT(*) FROM unionfind').fetchone()[0] for db in dbs]
+
+
+class SQLiteConsolidateUnionFindTestCase(UnionFindTestCase):
+    def test_consolidate_sqlite(self):
+        self.test_deunion()
+        db = sqlite3.connect(':memory:')
+        self.uf.consolidate(db, 'unionfind')
+        uf2 = UnionFind(db, 'unionfind', 'sqlite')
+        for el in db.execute('SELECT _id, parent, weight FROM unionfind').fetchall():
+            assert el[1] == self.uf.parents[el[0]]['parent']
+            assert el[2] == self.uf.parents[el[0]]['weight']
+            assert self.uf[el[0]] == uf2[el[0]]
+        self.uf.union('nathan', 'walt')
+        assert self.uf.consolidate(db, 'unionfind', incremental=True) == 2
+        for guy in ['nathan', 'mike', 'john', 'albert', 'walt']:
+            assert uf2[guy] == self.uf[guy]
+        assert not db.execute("SELECT name FROM sqlite_master WHERE name = 'unionfind_staging'").fetchall()
+
+    def test_consolidate_interned(self):
+        self.test_deunion()
+        self.uf.union('nathan', 'mike')
+        db = sqlite3.connect(':memory:')
+        assert self.uf.consolidate(db, 'unionfind', interned=True) == 4
+        assert all(isinstance(row[0], int) for row in db.execute('SELECT _id, parent FROM unionfind'))
+        uf2 = UnionFind(db, 'unionfind', 'sqlite', interned=True)
+        for guy in ['nathan', 'mike', 'john', 'albert']:
+            assert uf2[guy] == self.uf[guy]
+        self.uf.union('john', 'walt')
+        assert self.uf.consolidate(db, 'unionfind', incremental=True, interned=True) == 2
+        uf2 = UnionFind(db, 'unionfind', 'sqlite', interned=True)
+        assert uf2['walt'] == self.uf['walt'] == uf2['john']
+
+
 class MongoUnionFindTestCase(UnionFindTestCase):
     def setUp(self):
         mongo_client.drop_database(mongo_db)
@@ -166,6 +1086,27 @@ class MongoConsolidateUnionFindTestCase(UnionFindTestCase):
             assert self.uf.parents[el['_id']]['weight'] == uf2.parents[el['_id']]['weight']
 
 
+    def test_consolidate_chunks(self):
+        self.test_union()
+        count = MongoConsolidate(mongo_db, mongo_collection, chunk_size=3).consolidate(self.uf.parents.items())
+        assert count == mongo_db[mongo_collection].count() == 4
+        assert mongo_collection + '_staging' not in mongo_db.collection_names()
+
+
+    def test_consolidate_incremental(self):
+        self.test_union()
+        self.uf.consolidate(mongo_db, mongo_collection)
+        assert not self.uf.parents._dirty
+        self.uf.union('nathan', 'walt')
+        self.assertSetEqual(set(['nathan', 'walt']), self.uf.parents._dirty)
+        assert self.uf.consolidate(mongo_db, mongo_collection, incremental=True) == 2
+        assert not self.uf.parents._dirty
+        uf2 = UnionFind(mongo_db, mongo_collection)
+        for guy in ['nathan', 'mike', 'john', 'albert', 'walt']:
+            assert uf2[guy] == self.uf[guy]
+        assert uf2.parents['nathan']['weight'] == 5
+
+
 class MySQLConsolidateUnionFindTestCase(UnionFindTestCase):
     def setUp(self):
         with mysql_db:
@@ -196,6 +1137,25 @@ class MySQLConsolidateUnionFindTestCase(UnionFindTestCase):
             assert self.uf.parents[el['_id']]['weight'] == uf2.parents[el['_id']]['weight']
 
 
+    def test_consolidate_chunks(self):
+        self.test_union()
+        count = MySQLConsolidate(mysql_db, mysql_table, chunk_size=3).consolidate(self.uf.parents.items())
+        cur = mysql_db.cursor(MySQLdb.cursors.DictCursor)
+        cur.execute('SELECT * FROM %s' % mysql_table)
+        assert count == len(cur.fetchall()) == 4
+        cur.execute("SHOW TABLES LIKE '%s_staging'" % mysql_table)
+        assert not cur.fetchall()
+
+    def test_consolidate_incremental(self):
+        self.test_union()
+        self.uf.consolidate(mysql_db, mysql_table)
+        self.uf.union('nathan', 'walt')
+        assert self.uf.consolidate(mysql_db, mysql_table, incremental=True) == 2
+        uf2 = UnionFind(mysql_db, mysql_table, 'mysql')
+        for guy in ['nathan', 'mike', 'john', 'albert', 'walt']:
+            assert uf2[guy] == self.uf[guy]
+        assert uf2.parents['nathan']['weight'] == 5
+
     def test_consolidate_mysql_extra_fields(self):
         self.uf.deunion()
         self.uf.consolidate(mysql_db, mysql_table, gender='male', country='USA', state='NY')
@@ -249,6 +1209,19 @@ class ExtraFieldsTestCase(unittest.TestCase):
             else:
                 raise self.failureException
 
+    def test_shared_pool(self):
+        UnionFind().consolidate(mysql_db, mysql_table, role='player', type='individual')
+        pool = MySQLPool(lambda: MySQLdb.connect(dbhost, 'test', '', testdbname), size=2)
+        individuals = UnionFind(pool, mysql_table, 'mysql', role='player', type='individual')
+        organizations = UnionFind(pool, mysql_table, 'mysql', role='player', type='organization')
+        individuals.union('alpha', 'bravo')
+        organizations.union('adams', 'boston')
+        organizations.union('alpha', 'chicago')
+        assert individuals['alpha'] == individuals['bravo'] != individuals['chicago']
+        assert organizations['alpha'] == organizations['chicago'] != organizations['bravo']
+        assert pool.queries > 0
+        pool.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import bench_UnionFind
+
+
+class BenchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, 'bench_output.txt')
+        self.args = ['--size', '100', '--workloads', 'random', '--backends', 'dict', '--output', self.output]
+        self.run, self.import_time = bench_UnionFind.run, bench_UnionFind.import_time
+        bench_UnionFind.import_time = lambda: 0.0
+
+    def tearDown(self):
+        bench_UnionFind.run, bench_UnionFind.import_time = self.run, self.import_time
+        shutil.rmtree(self.dir)
+
+    def _main(self, elapsed, args):
+        # each timed run takes the next of the `elapsed` times, instead of the time measured,
+        # then the profiling run ignores it
+        elapsed = iter(elapsed)
+        bench_UnionFind.run = lambda ops, make_parents: (next(elapsed, None), self.run(ops, make_parents)[1])
+        status = bench_UnionFind.main(self.args + args)
+        with open(self.output) as f:
+            return status, json.load(f)
+
+    def test_compare_with_itself(self):
+        status, report = self._main([1.0] * 3, ['--repeat', '3'])
+        assert status == 0
+        assert report['results'][0]['repeat'] == 3
+        assert report['results'][0]['seconds'] == 1.0
+        baseline = os.path.join(self.dir, 'baseline.txt')
+        os.rename(self.output, baseline)
+
+        # the same code, with a run slowed down by something else on the machine
+        status, report = self._main([3.0, 1.0, 1.0], ['--repeat', '3', '--compare', baseline])
+        assert status == 0
+        assert report['regressions'] == []
+
+        # while a single run is taken at face value
+        status, report = self._main([3.0], ['--repeat', '1', '--compare', baseline])
+        assert status == 1
+        assert [(r['workload'], r['backend']) for r in report['regressions']] == [('random', 'dict')]
+
+
+if __name__ == '__main__':
+    unittest.main()